@@ -0,0 +1,309 @@
+"""
+Admission control at the API edge: what gets in, and when to say no.
+
+AdmissionMiddleware, in front of every route:
+
+1. Load shedding: while the event loop lags more than ADMISSION_MAX_LOOP_LAG
+   or a database connection takes longer than ADMISSION_MAX_POOL_WAIT to get,
+   new requests are refused with 503 + Retry-After (the page at /, metrics
+   and static files still pass). Both are sampled by `monitor` in the
+   background.
+2. Rate limits, per minute over a sliding window: every request per client
+   IP (ADMISSION_IP_RPM), sign-up / login / refresh per IP
+   (ADMISSION_AUTH_RPM, they cost a bcrypt hash), every request per user
+   (ADMISSION_USER_RPM) and turns per user (ADMISSION_REFLECT_RPM). 429 +
+   Retry-After past a limit.
+3. Body size: ADMISSION_MAX_BODY_BYTES (ADMISSION_MAX_IMPORT_BYTES for
+   /import), by Content-Length up front or counted while streaming. 413.
+
+Turns are also held to ADMISSION_DAILY_TOKENS per user and UTC day, counted
+from completion usage (charge(), check_quota() in chat.py).
+
+Counters live in shared.state: per process by default, across workers with
+SHARED_STATE_URL. The client IP is the connection's; run uvicorn with
+--proxy-headers (and --forwarded-allow-ips) behind a proxy.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from starlette.requests import HTTPConnection
+
+import auth
+import shared
+
+log = logging.getLogger(__name__)
+
+# === CONFIG ===
+# Requests per minute; 0 disables a limit.
+ADMISSION_IP_RPM           = int(os.getenv("ADMISSION_IP_RPM", 600))
+ADMISSION_AUTH_RPM         = int(os.getenv("ADMISSION_AUTH_RPM", 20))
+ADMISSION_USER_RPM         = int(os.getenv("ADMISSION_USER_RPM", 300))
+ADMISSION_REFLECT_RPM      = int(os.getenv("ADMISSION_REFLECT_RPM", 20))
+ADMISSION_MAX_BODY_BYTES   = int(os.getenv("ADMISSION_MAX_BODY_BYTES", 64 * 1024))
+ADMISSION_MAX_IMPORT_BYTES = int(os.getenv("ADMISSION_MAX_IMPORT_BYTES", 256 * 1024 * 1024))
+# Longest prompt accepted for a turn, in characters.
+MAX_PROMPT_CHARS           = int(os.getenv("MAX_PROMPT_CHARS", 8000))
+# Completion tokens (prompt + reply) per user per UTC day; 0: unlimited.
+ADMISSION_DAILY_TOKENS     = int(os.getenv("ADMISSION_DAILY_TOKENS", 500000))
+# Shed load past these (seconds); 0 disables the check.
+ADMISSION_MAX_LOOP_LAG     = float(os.getenv("ADMISSION_MAX_LOOP_LAG", 0.5))
+ADMISSION_MAX_POOL_WAIT    = float(os.getenv("ADMISSION_MAX_POOL_WAIT", 1.0))
+ADMISSION_SAMPLE_SECONDS   = float(os.getenv("ADMISSION_SAMPLE_SECONDS", 0.25))
+
+WINDOW = 60.0
+AUTH_PATHS = ("/signup", "/login", "/refresh")
+REFLECT_PATHS = ("/reflect", "/reflect/stream")
+# never shed or limited: the page shell and monitoring must work under load
+# ("/" itself is matched exactly)
+EXEMPT_PATHS = ("/metrics", "/static/")
+
+counters = {"shed": 0, "rate_limited": 0, "too_large": 0, "over_quota": 0}
+
+
+# === RATE LIMITS ===
+async def hit(name: str, key: Any, per_minute: int) -> float:
+    """
+    Count a request against `per_minute` over a sliding window. Returns 0
+    when allowed, else the seconds to wait.
+
+    Sliding window counter: this minute's count plus last minute's, weighted
+    by how much of last minute the window still covers. Two counters per
+    key, which any shared.state backend can hold. Fails open when the store
+    is unreachable.
+    """
+    if per_minute <= 0:
+        return 0.0
+    now = time.time()
+    slot = int(now // WINDOW)
+    elapsed = now / WINDOW - slot
+    try:
+        current = await shared.state.incr(f"rl:{name}:{key}:{slot}", 1, ttl=2 * WINDOW)
+        previous = int(await shared.state.get(f"rl:{name}:{key}:{slot - 1}") or 0)
+    except Exception:
+        log.warning("rate limit check failed", exc_info=True)
+        return 0.0
+    if previous * (1 - elapsed) + current <= per_minute:
+        return 0.0
+    # until enough of last minute has slid out (or this one has ended)
+    if previous and current <= per_minute:
+        return max(1.0, WINDOW * ((previous + current - per_minute) / previous - elapsed))
+    return max(1.0, WINDOW * (1 - elapsed))
+
+
+async def limit(name: str, key: Any, per_minute: int):
+    """
+    hit(), raising 429 past the limit.
+    """
+    wait = await hit(name, key, per_minute)
+    if wait:
+        counters["rate_limited"] += 1
+        raise HTTPException(429, "Too many requests, slow down", headers={"Retry-After": str(int(wait + 0.5))})
+
+
+# === DAILY TOKEN QUOTA ===
+def _quota_key(user_id: int) -> str:
+    return f"quota:{user_id}:{datetime.utcnow():%Y-%m-%d}"
+
+
+async def check_quota(user_id: int):
+    """
+    Refuse a turn once the user has used up today's tokens.
+    """
+    if ADMISSION_DAILY_TOKENS <= 0:
+        return
+    try:
+        used = int(await shared.state.get(_quota_key(user_id)) or 0)
+    except Exception:
+        log.warning("quota check failed", exc_info=True)
+        return
+    if used >= ADMISSION_DAILY_TOKENS:
+        counters["over_quota"] += 1
+        now = datetime.utcnow()
+        tomorrow = datetime(now.year, now.month, now.day) + timedelta(days=1)
+        raise HTTPException(429, "Daily usage limit reached",
+                            headers={"Retry-After": str(int((tomorrow - now).total_seconds()) + 1)})
+
+
+async def charge(user_id: int, usage: Any):
+    """
+    Count an upstream response's `usage` (may be None) against the quota.
+    Best effort: the reply is paid for already, a store error mustn't lose it.
+    """
+    if ADMISSION_DAILY_TOKENS <= 0 or usage is None or not usage.total_tokens:
+        return
+    try:
+        await shared.state.incr(_quota_key(user_id), usage.total_tokens, ttl=2 * 86400)
+    except Exception:
+        log.warning("quota charge failed", exc_info=True)
+
+
+# === LOAD ===
+class LoadMonitor:
+    """
+    Samples event loop lag (how late a timer fires) and database pool wait
+    (how long a probe acquire takes) every ADMISSION_SAMPLE_SECONDS.
+    """
+
+    def __init__(self):
+        self.db = None
+        self.loop_lag = 0.0
+        self.pool_wait = 0.0
+        self._probe_started: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, db):
+        self.db = db
+        if ADMISSION_SAMPLE_SECONDS > 0 and (ADMISSION_MAX_LOOP_LAG > 0 or ADMISSION_MAX_POOL_WAIT > 0):
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _probe(self):
+        self._probe_started = time.monotonic()
+        try:
+            async with self.db.acquire():
+                pass
+        finally:
+            self.pool_wait = time.monotonic() - self._probe_started
+            self._probe_started = None
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        probe: Optional[asyncio.Task] = None
+        while True:
+            expected = loop.time() + ADMISSION_SAMPLE_SECONDS
+            await asyncio.sleep(ADMISSION_SAMPLE_SECONDS)
+            self.loop_lag = max(0.0, loop.time() - expected)
+            # one probe at a time: a stuck one is itself the measurement
+            if ADMISSION_MAX_POOL_WAIT > 0 and (probe is None or probe.done()):
+                probe = asyncio.create_task(self._probe())
+
+    def overloaded(self) -> Optional[str]:
+        """
+        Why new work should be refused right now, or None.
+        """
+        if 0 < ADMISSION_MAX_LOOP_LAG < self.loop_lag:
+            return "event loop lag"
+        pool_wait = self.pool_wait
+        if self._probe_started is not None:
+            pool_wait = max(pool_wait, time.monotonic() - self._probe_started)
+        if 0 < ADMISSION_MAX_POOL_WAIT < pool_wait:
+            return "database pool wait"
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **counters,
+            "loop_lag_ms": round(self.loop_lag * 1000, 1),
+            "pool_wait_ms": round(self.pool_wait * 1000, 1),
+        }
+
+
+monitor = LoadMonitor()
+
+
+# === MIDDLEWARE ===
+class _BodyTooLarge(Exception):
+    pass
+
+
+class AdmissionMiddleware:
+    """
+    Sheds load, rate-limits and caps request bodies before the app runs.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        path = scope["path"]
+        if path == "/" or path.startswith(EXEMPT_PATHS):
+            return await self.app(scope, receive, send)
+        try:
+            await self._admit(scope, path)
+        except HTTPException as e:
+            return await self._refuse(scope, send, e)
+        if scope["type"] == "websocket":
+            return await self.app(scope, receive, send)
+
+        cap = ADMISSION_MAX_IMPORT_BYTES if path == "/import" else ADMISSION_MAX_BODY_BYTES
+        length = dict(scope["headers"]).get(b"content-length")
+        if cap > 0 and length is not None and length.isdigit() and int(length) > cap:
+            counters["too_large"] += 1
+            return await self._refuse(scope, send, HTTPException(413, f"Request body over {cap} bytes"))
+        if cap <= 0:
+            return await self.app(scope, receive, send)
+
+        # chunked (or lying) bodies are counted as they arrive
+        received = 0
+        overflow = started = False
+
+        async def receive_wrapper():
+            nonlocal received, overflow
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > cap:
+                    overflow = True
+                    raise _BodyTooLarge()
+            return message
+
+        async def send_wrapper(message):
+            nonlocal started
+            # FastAPI turns body read errors into a 400 of its own; ours wins
+            if overflow:
+                return
+            started = started or message["type"] == "http.response.start"
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        except _BodyTooLarge:
+            pass
+        if overflow:
+            counters["too_large"] += 1
+            if not started:
+                await self._refuse(scope, send, HTTPException(413, f"Request body over {cap} bytes"))
+
+    async def _admit(self, scope, path: str):
+        reason = monitor.overloaded()
+        if reason is not None:
+            counters["shed"] += 1
+            log.warning("shedding %s %s: %s", scope.get("method", "WS"), path, reason)
+            raise HTTPException(503, "Server busy, try again shortly", headers={"Retry-After": "1"})
+        connection = HTTPConnection(scope)
+        ip = connection.client.host if connection.client else "unknown"
+        await limit("ip", ip, ADMISSION_IP_RPM)
+        if path in AUTH_PATHS:
+            await limit("auth", ip, ADMISSION_AUTH_RPM)
+        token = connection.cookies.get(auth.ACCESS_COOKIE)
+        if not token:
+            return
+        try:
+            user_id = auth.verify_access(token)["sub"]
+        except HTTPException:
+            return  # the route answers 401 itself
+        await limit("user", user_id, ADMISSION_USER_RPM)
+        if path in REFLECT_PATHS:
+            await limit("reflect", user_id, ADMISSION_REFLECT_RPM)
+
+    @staticmethod
+    async def _refuse(scope, send, error: HTTPException):
+        if scope["type"] == "websocket":
+            # 1013: try again later
+            await send({"type": "websocket.close", "code": 1013, "reason": str(error.detail)})
+            return
+        response = JSONResponse({"detail": error.detail}, status_code=error.status_code, headers=error.headers)
+        await response(scope, None, send)
@@ -0,0 +1,144 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+from typing import Dict, Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+
+log = logging.getLogger(__name__)
+
+# === CONFIG ===
+ROOT         = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR   = os.path.join(ROOT, "static")
+SHELL_PATH   = os.path.join(ROOT, "index.html")
+# "1" re-reads changed files on request (development only: stats every file).
+ASSETS_RELOAD = os.getenv("ASSETS_RELOAD", "0") == "1"
+
+try:
+    import brotli
+except ImportError:  # gzip alone is fine
+    brotli = None
+
+IMMUTABLE   = "public, max-age=31536000, immutable"
+REVALIDATE  = "no-cache"
+_STATIC_REF = re.compile(r'/static/([\w.-]+)')
+
+
+class Asset:
+    """
+    One file held in memory with its precompressed variants.
+    """
+
+    __slots__ = ("path", "mtime", "body", "variants", "digest", "media_type")
+
+    def __init__(self, path: str, body: bytes):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        self.body = body
+        self.digest = hashlib.sha256(body).hexdigest()[:12]
+        self.media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if self.media_type.startswith("text/") or self.media_type.endswith("javascript"):
+            self.media_type += "; charset=utf-8"
+        # encoding -> body; only kept when smaller than the original
+        self.variants: Dict[str, bytes] = {}
+        compressed = gzip.compress(body, 9, mtime=0)
+        if len(compressed) < len(body):
+            self.variants["gzip"] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(body, quality=11)
+            if len(compressed) < len(body):
+                self.variants["br"] = compressed
+
+
+class AssetStore:
+    """
+    The page shell and static assets, read and compressed once.
+
+    Assets get content-hashed URLs (/static/script.<hash>.js) served with an
+    immutable Cache-Control; the shell is rewritten to point at them and is
+    revalidated by ETag. Unhashed /static/<name> URLs still work, revalidated
+    like the shell.
+    """
+
+    def __init__(self, static_dir: str = STATIC_DIR, shell_path: str = SHELL_PATH):
+        self.static_dir = static_dir
+        self.shell_path = shell_path
+        self.assets: Dict[str, Asset] = {}  # plain name -> asset
+        self.hashed: Dict[str, str] = {}    # hashed name -> plain name
+        self.shell: Optional[Asset] = None
+
+    def url(self, name: str) -> str:
+        asset = self.assets.get(name)
+        if asset is None:
+            return f"/static/{name}"
+        stem, ext = os.path.splitext(name)
+        return f"/static/{stem}.{asset.digest}{ext}"
+
+    def load(self):
+        assets, hashed = {}, {}
+        for name in sorted(os.listdir(self.static_dir)):
+            path = os.path.join(self.static_dir, name)
+            if not os.path.isfile(path):
+                continue
+            with open(path, "rb") as f:
+                assets[name] = Asset(path, f.read())
+            stem, ext = os.path.splitext(name)
+            hashed[f"{stem}.{assets[name].digest}{ext}"] = name
+        self.assets, self.hashed = assets, hashed
+
+        with open(self.shell_path, "rb") as f:
+            html = f.read().decode("utf-8")
+        html = _STATIC_REF.sub(lambda m: self.url(m.group(1)), html)
+        self.shell = Asset(self.shell_path, html.encode("utf-8"))
+        log.info("loaded %d assets, shell %s", len(assets), self.shell.digest)
+
+    def _reload_if_changed(self):
+        try:
+            stale = self.shell is None or os.stat(self.shell_path).st_mtime != self.shell.mtime
+            names = os.listdir(self.static_dir)
+            stale = stale or set(names) != set(self.assets) or any(
+                os.stat(a.path).st_mtime != a.mtime for a in self.assets.values()
+            )
+        except FileNotFoundError:
+            stale = True
+        if stale:
+            self.load()
+
+    # === RESPONSES ===
+    def _respond(self, asset: Asset, request: Request, cache_control: str) -> Response:
+        accepted = request.headers.get("accept-encoding", "")
+        encoding = next((e for e in ("br", "gzip") if e in asset.variants and e in accepted), None)
+        etag = f'"{asset.digest}-{encoding}"' if encoding else f'"{asset.digest}"'
+        headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+
+        match = request.headers.get("if-none-match")
+        if match and (match.strip() == "*" or etag in [t.strip().removeprefix("W/") for t in match.split(",")]):
+            return Response(status_code=304, headers=headers)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        body = asset.variants[encoding] if encoding else asset.body
+        return Response(body, media_type=asset.media_type, headers=headers)
+
+    def page(self, request: Request) -> Response:
+        if ASSETS_RELOAD:
+            self._reload_if_changed()
+        return self._respond(self.shell, request, REVALIDATE)
+
+    def static(self, name: str, request: Request) -> Response:
+        if ASSETS_RELOAD:
+            self._reload_if_changed()
+        plain = self.hashed.get(name)
+        if plain is not None:
+            return self._respond(self.assets[plain], request, IMMUTABLE)
+        asset = self.assets.get(name)
+        if asset is None:
+            return Response(status_code=404)
+        return self._respond(asset, request, REVALIDATE)
+
+
+store = AssetStore()
+store.load()
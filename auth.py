@@ -0,0 +1,231 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from asyncpg import Pool
+from fastapi import Cookie, HTTPException
+from fastapi.responses import Response
+from jose import JWTError, jwt
+
+import shared
+
+log = logging.getLogger(__name__)
+
+# === CONFIG ===
+JWT_SECRET    = os.getenv("JWT_SECRET", "your-very-secret-key")
+ALGORITHM     = "HS256"
+ACCESS_TOKEN_SECONDS  = int(os.getenv("ACCESS_TOKEN_SECONDS", 15 * 60))
+REFRESH_TOKEN_SECONDS = int(os.getenv("REFRESH_TOKEN_SECONDS", 30 * 24 * 3600))
+# Verified access tokens kept in memory so repeat requests skip the signature check.
+AUTH_CACHE_SIZE       = int(os.getenv("AUTH_CACHE_SIZE", 4096))
+# How often the shared revocation version is checked; the table is only read
+# when it moved. A token revoked by another worker may keep working here for
+# up to this long.
+REVOCATION_POLL_SECONDS    = float(os.getenv("REVOCATION_POLL_SECONDS", 1))
+# Read the table regardless this often, in case shared state isn't shared.
+REVOCATION_REFRESH_SECONDS = float(os.getenv("REVOCATION_REFRESH_SECONDS", 30))
+
+ACCESS_COOKIE  = "access_token"
+REFRESH_COOKIE = "refresh_token"
+
+
+class Revocations:
+    """
+    In-memory copy of revoked_tokens (token id -> expiry, epoch seconds).
+
+    Loaded whole at startup, then only rows past the highest id seen are read
+    when another worker signals a revocation through shared state, so
+    checking a token never touches the database. Entries are dropped once
+    the tokens they block have expired anyway.
+    """
+
+    def __init__(self):
+        self.db: Optional[Pool] = None
+        self._ids: Dict[str, float] = {}
+        self._seen = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def __contains__(self, token_id: str) -> bool:
+        return token_id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    async def start(self, db: Pool):
+        self.db = db
+        await db.execute("DELETE FROM revoked_tokens WHERE expires_at < now()")
+        await self.refresh()
+        self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def refresh(self):
+        rows = await self.db.fetch(
+            "SELECT id, token_id, expires_at FROM revoked_tokens WHERE id > $1 ORDER BY id",
+            self._seen,
+        )
+        for r in rows:
+            self._ids[r["token_id"]] = r["expires_at"].timestamp()
+            self._seen = r["id"]
+        now = time.time()
+        for token_id in [t for t, expires in self._ids.items() if expires < now]:
+            del self._ids[token_id]
+
+    async def _poll(self):
+        version, refreshed = None, time.monotonic()
+        while True:
+            await asyncio.sleep(REVOCATION_POLL_SECONDS)
+            try:
+                current = await shared.state.get("revocations:version")
+                if current != version or time.monotonic() - refreshed >= REVOCATION_REFRESH_SECONDS:
+                    await self.refresh()
+                    version, refreshed = current, time.monotonic()
+            except Exception:
+                log.warning("revocation refresh failed", exc_info=True)
+
+    async def revoke(self, token_id: str, expires: float):
+        self._ids[token_id] = expires
+        await self.db.execute(
+            """
+            INSERT INTO revoked_tokens (token_id, expires_at) VALUES ($1, $2)
+            ON CONFLICT (token_id) DO NOTHING
+            """,
+            token_id, datetime.fromtimestamp(expires, timezone.utc),
+        )
+        await shared.state.incr("revocations:version")
+
+
+revocations = Revocations()
+# raw access token -> verified claims, most recently used last
+_verified: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+
+# === TOKENS ===
+def _encode(user_id: int, kind: str, login_id: str, ttl: int) -> str:
+    now = int(time.time())
+    return jwt.encode(
+        {
+            "sub": str(user_id),
+            "typ": kind,
+            "jti": uuid.uuid4().hex,
+            # shared by every token issued for one login, so logout can
+            # revoke the refresh token and its access tokens together
+            "lid": login_id,
+            "iat": now,
+            "exp": now + ttl,
+        },
+        JWT_SECRET,
+        algorithm=ALGORITHM,
+    )
+
+
+def _decode(token: str, kind: str) -> Dict[str, Any]:
+    try:
+        claims = jwt.decode(
+            token, JWT_SECRET, algorithms=[ALGORITHM],
+            options={"require_exp": True, "require_jti": True, "require_sub": True},
+        )
+    except JWTError:
+        raise HTTPException(401, "Invalid token")
+    if claims.get("typ") != kind or "lid" not in claims:
+        raise HTTPException(401, "Invalid token")
+    return claims
+
+
+def revoked(claims: Dict[str, Any]) -> bool:
+    return claims["lid"] in revocations or claims["jti"] in revocations
+
+
+def _check_revoked(claims: Dict[str, Any]):
+    if revoked(claims):
+        raise HTTPException(401, "Token revoked")
+
+
+def verify_access(token: str) -> Dict[str, Any]:
+    """
+    Claims of a valid, unrevoked access token. Cached after the first
+    signature check; expiry and revocation are still checked every time.
+    """
+    claims = _verified.get(token)
+    if claims is None:
+        claims = _decode(token, "access")
+        _verified[token] = claims
+        if len(_verified) > AUTH_CACHE_SIZE:
+            _verified.popitem(last=False)
+    else:
+        _verified.move_to_end(token)
+        if claims["exp"] <= time.time():
+            del _verified[token]
+            raise HTTPException(401, "Token expired")
+    _check_revoked(claims)
+    return claims
+
+
+def issue(resp: Response, user_id: int, login_id: Optional[str] = None):
+    """
+    Set fresh access and refresh cookies on `resp`. A new login gets a new
+    login id; a refresh keeps the one it had.
+    """
+    login_id = login_id or uuid.uuid4().hex
+    resp.set_cookie(
+        ACCESS_COOKIE, _encode(user_id, "access", login_id, ACCESS_TOKEN_SECONDS),
+        max_age=ACCESS_TOKEN_SECONDS, httponly=True, samesite="lax",
+    )
+    resp.set_cookie(
+        REFRESH_COOKIE, _encode(user_id, "refresh", login_id, REFRESH_TOKEN_SECONDS),
+        max_age=REFRESH_TOKEN_SECONDS, httponly=True, samesite="strict",
+    )
+
+
+def refresh(resp: Response, refresh_token: Optional[str]) -> int:
+    """
+    Exchange a refresh token for new cookies. Returns the user id.
+    """
+    if not refresh_token:
+        raise HTTPException(401, "Not authenticated")
+    claims = _decode(refresh_token, "refresh")
+    _check_revoked(claims)
+    issue(resp, int(claims["sub"]), claims["lid"])
+    return int(claims["sub"])
+
+
+async def logout(resp: Response, access_token: Optional[str], refresh_token: Optional[str]):
+    """
+    Revoke the login behind whichever token is still readable and clear both cookies.
+    """
+    for token, kind in ((refresh_token, "refresh"), (access_token, "access")):
+        if not token:
+            continue
+        try:
+            claims = _decode(token, kind)
+        except HTTPException:
+            continue
+        # the refresh token outlives every access token of its login
+        expires = claims["exp"] if kind == "refresh" else claims["iat"] + REFRESH_TOKEN_SECONDS
+        await revocations.revoke(claims["lid"], expires)
+        break
+    resp.delete_cookie(ACCESS_COOKIE)
+    resp.delete_cookie(REFRESH_COOKIE)
+
+
+# === DEPENDENCY ===
+async def get_current_user(
+    access_token: str = Cookie(None, alias=ACCESS_COOKIE)
+) -> Dict[str, Any]:
+    if not access_token:
+        raise HTTPException(401, "Not authenticated")
+    claims = verify_access(access_token)
+    return {"id": int(claims["sub"]), "login_id": claims["lid"]}
+
+
+def stats() -> Dict[str, Any]:
+    return {"verified_cached": len(_verified), "revoked": len(revocations)}
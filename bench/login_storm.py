@@ -0,0 +1,83 @@
+"""
+Event-loop latency under a concurrent login storm, bcrypt inline vs pooled.
+
+    python bench/login_storm.py --logins 64
+
+A ticker coroutine sleeps TICK seconds in a loop and records how late it
+wakes up; that lateness is what every other request on the loop would see.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import hashing  # noqa: E402
+
+TICK = 0.005
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+async def ticker(lags, stop):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(TICK)
+        lags.append((loop.time() - start - TICK) * 1000)
+
+
+async def inline_login(password, password_hash):
+    # what main.login used to do: verify right on the event loop
+    return hashing.pwd_context.verify(password, password_hash)
+
+
+async def pooled_login(password, password_hash):
+    try:
+        return (await hashing.verify_password(password, password_hash))[0]
+    except Exception:  # 503 under saturation
+        return None
+
+
+async def storm(login, n, password_hash):
+    lags, stop = [], asyncio.Event()
+    tick = asyncio.create_task(ticker(lags, stop))
+    started = time.perf_counter()
+    results = await asyncio.gather(*(login("pw", password_hash) for _ in range(n)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await tick
+    return {
+        "logins": n,
+        "rejected": sum(r is None for r in results),
+        "wall_s": round(elapsed, 3),
+        "loop_lag_p50_ms": round(percentile(lags, 0.50), 2),
+        "loop_lag_p99_ms": round(percentile(lags, 0.99), 2),
+        "loop_lag_max_ms": round(max(lags, default=0.0), 2),
+        "loop_lag_mean_ms": round(statistics.fmean(lags), 2) if lags else 0.0,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=32)
+    args = parser.parse_args()
+    password_hash = hashing.pwd_context.hash("pw")
+    report = {
+        "workers": hashing.HASH_WORKERS,
+        "queue_limit": hashing.HASH_QUEUE_LIMIT,
+        "inline": await storm(inline_login, args.logins, password_hash),
+        "pooled": await storm(pooled_login, args.logins, password_hash),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,154 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import prompt
+import shared
+
+log = logging.getLogger(__name__)
+
+# === CONFIG ===
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 1024))
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", 3600))
+
+
+def _normalize(messages: List[Dict[str, str]]) -> List[Tuple[str, str]]:
+    # case and whitespace don't change what the model is asked
+    return [(m["role"], " ".join(m["content"].split()).casefold()) for m in messages]
+
+
+class CompletionCache:
+    """
+    Content-addressed cache of completions with single-flight coalescing.
+
+    Keys hash the model, the system prompt version and the normalised
+    message list. Entries live in an in-process LRU with a TTL, backed by
+    the shared state tier when one is configured (see shared.py), so
+    workers reuse each other's completions. Concurrent misses for the same
+    key share one upstream call.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        ttl: float = CACHE_TTL_SECONDS,
+        backend=None,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.counters = {"hits": 0, "shared_hits": 0, "misses": 0, "coalesced": 0, "evictions": 0}
+
+    def key(self, model: str, messages: List[Dict[str, str]]) -> str:
+        payload = json.dumps(
+            [model, prompt.PROMPT_VERSION, _normalize(messages)],
+            ensure_ascii=False, separators=(",", ":"),
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _get_local(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set_local(self, key: str, value: str):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    async def get(self, key: str) -> Optional[str]:
+        value = self._get_local(key)
+        if value is not None:
+            self.counters["hits"] += 1
+            return value
+        if self.backend is not None:
+            try:
+                value = await self.backend.get("completion:" + key)
+            except Exception:
+                log.warning("shared cache get failed", exc_info=True)
+            if value is not None:
+                self.counters["shared_hits"] += 1
+                self._set_local(key, value)
+                return value
+        return None
+
+    async def set(self, key: str, value: str):
+        self._set_local(key, value)
+        if self.backend is not None:
+            try:
+                await self.backend.set("completion:" + key, value, self.ttl)
+            except Exception:
+                log.warning("shared cache set failed", exc_info=True)
+
+    async def get_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[Tuple[str, bool]]],
+    ) -> Tuple[str, str]:
+        """
+        Returns (value, status) with status "hit", "coalesced" or "miss".
+        `compute` returns the value and whether it may be stored under `key`
+        (concurrent waiters get it either way). Errors from `compute` reach
+        every waiter and are not cached.
+        """
+        value = await self.get(key)
+        if value is not None:
+            return value, "hit"
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.counters["coalesced"] += 1
+            try:
+                return await asyncio.shield(inflight), "coalesced"
+            except asyncio.CancelledError:
+                # the leading request was cancelled, not us: try again ourselves
+                if inflight.cancelled() and not asyncio.current_task().cancelling():
+                    return await self.get_or_compute(key, compute)
+                raise
+
+        self.counters["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value, cacheable = await compute()
+            if cacheable:
+                await self.set(key, value)
+            future.set_result(value)
+            return value, "miss"
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # nobody may be waiting; don't warn about an unretrieved exception
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.counters["hits"] + self.counters["shared_hits"] + self.counters["misses"] + self.counters["coalesced"]
+        served = lookups - self.counters["misses"]
+        return {
+            **self.counters,
+            "size": len(self._entries),
+            "inflight": len(self._inflight),
+            "hit_ratio": round(served / lookups, 4) if lookups else 0.0,
+        }
+
+
+completion_cache = CompletionCache(backend=shared.state if shared.state.shared else None)
@@ -1,114 +1,409 @@
+import asyncio
+import logging
 import os
+import time
 import uuid
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator, Optional, Tuple
 
-from openai import AsyncOpenAI
 from asyncpg import Pool
+from fastapi import HTTPException
 
-from principles import principles
-from questions import questions
+from history import HISTORY_MAX_MESSAGES, build_history, count_tokens
+from memory import MemoryIndex, make_embedder
+import admission
+import jobs
+import lifecycle
+import llm
+import queries
+import metrics
+import titles
+from cache import completion_cache
+from prompt import build_messages
+from scheduler import SCHEDULER_REPLY_TOKENS, scheduler
+
+log = logging.getLogger(__name__)
 
 # === AI SETUP ===
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_API_KEY:
-    raise RuntimeError("You must set OPENAI_API_KEY")
+# Backends, models and failover are configured in llm.py.
+SUMMARY_MAX_WORDS = int(os.getenv("SUMMARY_MAX_WORDS", 250))
+# "1" asks the title tier (llm.TITLE_MODEL) for a session title when the
+# first prompt is too thin for titles.heuristic_title.
+SESSION_TITLE_LLM = os.getenv("SESSION_TITLE_LLM", "0") == "1"
+memory_index = MemoryIndex(make_embedder(llm.embed_backend))
+# memories_since for a turn that skips memories (above any SERIAL id)
+NO_MEMORIES = 2**31 - 1
+
+# Strong references to fire-and-forget tasks so they aren't garbage collected.
+_background: set = set()
+
+def spawn(coro) -> asyncio.Task:
+    """
+    Run `coro` detached from the caller. Safe to call from a `finally` block
+    of a cancelled request, where awaiting is no longer possible.
+    """
+    task = asyncio.create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+def pending() -> int:
+    """
+    Detached tasks still running (e.g. streams being closed and persisted).
+    """
+    return len(_background)
 
-openai = AsyncOpenAI(api_key=OPENAI_API_KEY)
 
 # === MEMORY HELPERS ===
+def _memory_candidates(new_messages: List[Dict[str, Any]]) -> List[str]:
+    # for simplicity, we’ll just take any user messages longer than 100 chars
+    return [
+        m["content"][:500] for m in new_messages
+        if m["role"] == "user" and len(m["content"]) > 100
+    ]
+
+async def _store_memories(db: Pool, items: List[Tuple[int, str]]):
+    """
+    Embed and insert (user_id, content) pairs with one embedding call and one
+    statement. Near-duplicates are merged later by consolidation.py.
+    """
+    if not items:
+        return
+    vectors = await memory_index.embed([c for _, c in items])
+    async with db.acquire() as conn:
+        await queries.store_memories(conn, [
+            (user_id, c, memory_index.encode(v), memory_index.embedder.name)
+            for (user_id, c), v in zip(items, vectors)
+        ])
+
 async def seed_user_memory(db: Pool, user_id: int, new_messages: List[Dict[str, Any]]):
     """
     Extract “important” sentences from the last chunk of conversation and store
-    them as user memories.
+    them as user memories, embedded for retrieval.
     """
-    # for simplicity, we’ll just take any user messages longer than 100 chars
-    for m in new_messages:
-        if m["role"] == "user" and len(m["content"]) > 100:
-            await db.execute(
-                """
-                INSERT INTO memories (user_id, content)
-                VALUES ($1, $2)
-                ON CONFLICT DO NOTHING
-                """,
-                user_id,
-                m["content"][:500]
-            )
+    await _store_memories(db, [(user_id, c) for c in _memory_candidates(new_messages)])
 
-async def fetch_user_memories(db: Pool, user_id: int) -> List[str]:
-    rows = await db.fetch(
-        "SELECT content FROM memories WHERE user_id=$1 ORDER BY created_at DESC LIMIT 5",
-        user_id,
-    )
-    return [r["content"] for r in rows]
+async def fetch_user_memories(db: Pool, user_id: int, prompt: str) -> List[str]:
+    """
+    The user's memories most similar to `prompt`.
+    """
+    [matches] = await memory_index.search(db, user_id, [prompt])
+    return [content for _, content in matches]
 
 
-# === MAIN REFLECT FUNCTION ===
-async def reflect(
+# === HISTORY SUMMARY ===
+async def summarize_history(
+    summary: str,
+    messages: List[Dict[str, str]],
+    user_id: int = 0,
+) -> str:
+    """
+    Fold `messages` into the running session summary.
+    """
+    transcript = "\n\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    tokens = count_tokens(summary) + count_tokens(transcript) + 2 * SUMMARY_MAX_WORDS
+    with metrics.stage("summarize"):
+        response, model = await llm.router.call(
+            "summary", user_id, tokens,
+            [
+                {
+                    "role": "system",
+                    "content": (
+                        "You maintain a running summary of a reflective conversation. "
+                        "Merge the new exchanges into the existing summary, keeping the "
+                        "user's themes, feelings, decisions and open questions. "
+                        f"Stay under {SUMMARY_MAX_WORDS} words."
+                    ),
+                },
+                {
+                    "role": "user",
+                    "content": f"Existing summary:\n{summary or '(none)'}\n\nNew exchanges:\n{transcript}",
+                },
+            ],
+        )
+    metrics.record_usage(model, response.usage)
+    await admission.charge(user_id, response.usage)
+    return response.choices[0].message.content.strip()
+
+
+# === TURN HELPERS ===
+async def _embed_prompt(prompt: Optional[str]):
+    """
+    The prompt's memory search vector; None when memories are skipped or
+    the embedder fails.
+    """
+    if prompt is None:
+        return None
+    try:
+        [vector] = await memory_index.embed([prompt])
+        return vector
+    except Exception:
+        log.warning("prompt embedding failed; turn without memories", exc_info=True)
+        return None
+
+
+async def _prepare(
     db: Pool,
     prompt: str,
     user_id: int,
     session_id: str,
-) -> List[Dict[str, str]]:
-    # 1) get past chat messages
-    msgs = await db.fetch(
-        """
-        SELECT role, content
-          FROM messages
-         WHERE session_id = $1
-           AND user_id    = $2
-         ORDER BY created_at
-        """,
-        session_id,
-        user_id,
-    )
-    history = [{"role": r["role"], "content": r["content"]} for r in msgs]
+) -> Dict[str, Any]:
+    """
+    Build everything a turn needs before calling upstream: the message list,
+    its token counts, a pending history summary update for _persist(), and
+    the completion cache key (None when the session opted out).
+    """
+    await admission.check_quota(user_id)
+
+    # 1) options, summary, history tail and new memory rows in one query.
+    #    Memories are an extra: if the embedder fails, the turn goes on
+    #    without them (memories_since None).
+    with metrics.stage("memory_backfill"):
+        try:
+            memories_since = await memory_index.prepare(db, user_id)
+        except Exception:
+            log.warning("memory backfill failed; turn without memories", exc_info=True)
+            memories_since = None
+    since = NO_MEMORIES if memories_since is None else memories_since
+    with metrics.stage("context"):
+        async with db.acquire() as conn:
+            context = await queries.load_turn_context(
+                conn, session_id, user_id, HISTORY_MAX_MESSAGES, since, memory_index.embedder.name,
+            )
+        if context["archived"]:
+            # a session reopened after months: its history is on disk.
+            # rehydrate takes its own connection, so ours is released first.
+            await lifecycle.rehydrate(db, session_id, user_id)
+            async with db.acquire() as conn:
+                context = await queries.load_turn_context(
+                    conn, session_id, user_id, HISTORY_MAX_MESSAGES, since, memory_index.embedder.name,
+                )
+            if context["archived"]:
+                # the archive couldn't be read (logged); replying without its
+                # history would also hide the new messages until it comes back
+                raise HTTPException(503, "Session archive unavailable, try again later")
+    if not context["found"]:
+        raise HTTPException(404, "Session not found")
+
+    # 2) token-budgeted history + rolling summary (may call the summariser),
+    #    while the prompt is embedded for memory search
+    with metrics.stage("history"):
+        (history, summary_update), query_vector = await asyncio.gather(
+            build_history(
+                context["summary"], context["history"],
+                lambda summary, messages: summarize_history(summary, messages, user_id),
+            ),
+            _embed_prompt(prompt if memories_since is not None else None),
+        )
 
-    # 2) get top user memories
-    memories = await fetch_user_memories(db, user_id)
-    if memories:
+    # 3) top user memories
+    matches = []
+    if memories_since is not None:
+        with metrics.stage("memory_search"):
+            await memory_index.sync(db, user_id, context["memories"], context["memory_epoch"])
+            if query_vector is not None:
+                [matches] = memory_index.query(user_id, query_vector[None, :])
+    if matches:
         history.insert(
             0,
             {
                 "role": "system",
                 "content": "Here are some things I know about the user:\n\n"
-                + "\n– ".join(memories),
+                + "\n– ".join(content for _, content in matches),
             },
         )
 
-    # 3) build system prompt
-    system_parts = [
-        "# — System prompt for AI —",
-        "You are a compassionate, patient, and measured mirror of the user.",
-        "Respond in a neutral, reflective tone, combining empathetic insights and gentle guidance.",
-        "Use no more than one or two open-ended questions per reply.",
-        *principles,
-        "You may ask one of these deeper questions if it feels natural:\n\n" + "\n".join(questions),
-    ]
-    system_prompt = "\n\n".join(system_parts)
+    # 4) static system prompt + history + this turn's questions and prompt
+    with metrics.stage("prompt"):
+        messages, tokens = build_messages(prompt, history)
+    return {
+        "prompt": prompt,
+        "user_id": user_id,
+        "session_id": session_id,
+        "messages": messages,
+        "tokens": tokens,
+        "summary_update": summary_update,
+        # the model the cache key names: a failover reply isn't cached under it
+        "model": llm.router.model("chat"),
+        "cache_key": completion_cache.key(llm.router.model("chat"), messages) if context["cache"] else None,
+    }
 
-    # 4) append our new user prompt
-    history.append({"role": "user", "content": prompt})
 
-    # 5) call OpenAI
-    response = await openai.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "system", "content": system_prompt}, *history],
-    )
-    ai_msg = response.choices[0].message
-
-    # 6) persist both sides
-    await db.execute(
-        """
-        INSERT INTO messages (session_id, user_id, role, content)
-        VALUES ($1, $2, 'user', $3), ($1, $2, 'assistant', $4)
-        """,
-        session_id,
-        user_id,
-        prompt,
-        ai_msg.content,
+async def _persist(db: Pool, turn: Dict[str, Any], reply: str):
+    # both sides of the turn + session touch (+ folded summary), one round trip
+    with metrics.stage("persist"):
+        async with db.acquire() as conn:
+            session = await queries.append_turn(
+                conn, turn["session_id"], turn["user_id"], turn["prompt"], reply,
+                turn["summary_update"],
+            )
+
+    # titling and memory extraction happen off the response path
+    if session and session["title_auto"] and session["message_count"] <= 2:
+        await jobs.queue.enqueue("title_session", {
+            "user_id": turn["user_id"], "session_id": turn["session_id"],
+            "prompt": turn["prompt"][:2000], "reply": reply[:2000],
+        })
+    user_message = {"role": "user", "content": turn["prompt"]}
+    if _memory_candidates([user_message]):
+        await jobs.queue.enqueue(
+            "seed_memory", {"user_id": turn["user_id"], "messages": [user_message]}
+        )
+
+
+def _reserve(turn: Dict[str, Any]) -> int:
+    # tokens held against the per-minute budget until usage is known
+    return turn["tokens"]["static"] + turn["tokens"]["dynamic"] + SCHEDULER_REPLY_TOKENS
+
+
+async def _complete(turn: Dict[str, Any]) -> Tuple[str, bool]:
+    """
+    The reply, and whether it came from the model the turn's cache key names.
+    """
+    with metrics.stage("upstream"):
+        response, model = await llm.router.call("chat", turn["user_id"], _reserve(turn), turn["messages"])
+    metrics.record_usage(model, response.usage)
+    await admission.charge(turn["user_id"], response.usage)
+    return response.choices[0].message.content, model == turn["model"]
+
+
+# === BACKGROUND JOBS ===
+async def _seed_memory_job(db: Pool, payloads: List[Dict[str, Any]]):
+    await _store_memories(db, [
+        (p["user_id"], c) for p in payloads for c in _memory_candidates(p["messages"])
+    ])
+
+jobs.queue.register("seed_memory", _seed_memory_job)
+
+
+async def _llm_title(user_id: int, prompt: str, reply: str) -> Optional[str]:
+    tokens = count_tokens(prompt) + count_tokens(reply) + 64
+    with metrics.stage("title"):
+        response, model = await llm.router.call(
+            "title", user_id, tokens,
+            [
+                {
+                    "role": "system",
+                    "content": (
+                        f"Name this conversation in at most {titles.SESSION_TITLE_MAX_WORDS} words. "
+                        "Reply with the title only."
+                    ),
+                },
+                {"role": "user", "content": f"User: {prompt}\n\nAssistant: {reply}"},
+            ],
+        )
+    metrics.record_usage(model, response.usage)
+    await admission.charge(user_id, response.usage)
+    return titles.clean_title(response.choices[0].message.content or "")
+
+
+async def _title_session_job(db: Pool, payloads: List[Dict[str, Any]]):
+    # the sessions trigger pushes the new title to open sockets
+    updates = []
+    for p in payloads:
+        title = titles.heuristic_title(p["prompt"])
+        if title is None and SESSION_TITLE_LLM:
+            title = await _llm_title(p["user_id"], p["prompt"], p["reply"])
+        if title:
+            updates.append((p["session_id"], p["user_id"], title))
+    if updates:
+        await db.executemany(queries.SET_AUTO_TITLE_SQL, updates)
+
+jobs.queue.register("title_session", _title_session_job)
+
+
+# === MAIN REFLECT FUNCTION ===
+async def reflect(
+    db: Pool,
+    prompt: str,
+    user_id: int,
+    session_id: str,
+) -> Dict[str, Any]:
+    turn = await _prepare(db, prompt, user_id, session_id)
+
+    if turn["cache_key"]:
+        reply, cache_status = await completion_cache.get_or_compute(
+            turn["cache_key"], lambda: _complete(turn)
+        )
+    else:
+        (reply, _), cache_status = await _complete(turn), "bypass"
+
+    await _persist(db, turn, reply)
+
+    return {
+        "messages": [{"role": "assistant", "content": reply}],
+        "tokens": turn["tokens"],
+        "cache": cache_status,
+    }
+
+
+async def reflect_stream(
+    db: Pool,
+    prompt: str,
+    user_id: int,
+    session_id: str,
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Streaming variant of reflect(). Yields a {"tokens": ..., "cache": ...}
+    event, then one {"delta": str} event per upstream chunk (a cache hit is a
+    single delta).
+
+    The turn is persisted once the generator finishes, including when the
+    client goes away mid-stream: the upstream stream is closed and whatever
+    text was generated so far is saved. Only complete replies from the
+    cache key's model are cached.
+    """
+    turn = await _prepare(db, prompt, user_id, session_id)
+    cached, cache_status = None, "bypass"
+    if turn["cache_key"]:
+        cached = await completion_cache.get(turn["cache_key"])
+        cache_status = "miss" if cached is None else "hit"
+    yield {"tokens": turn["tokens"], "cache": cache_status}
+
+    if cached is not None:
+        yield {"delta": cached}
+        await _persist(db, turn, cached)
+        return
+
+    # the scheduler slot is held until _finish_stream releases it
+    started = time.perf_counter()
+    stream, model = await llm.router.open(
+        "chat", turn["user_id"], _reserve(turn), turn["messages"],
+        stream=True, stream_options={"include_usage": True},
     )
+    parts: List[str] = []
+    usage = None
+    completed = False
+    try:
+        async for chunk in stream:
+            usage = chunk.usage or usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                if not parts:
+                    metrics.observe_stage("upstream_first_token", time.perf_counter() - started)
+                parts.append(chunk.choices[0].delta.content)
+                yield {"delta": parts[-1]}
+        completed = True
+    finally:
+        metrics.observe_stage("upstream", time.perf_counter() - started)
+        # we may be unwinding a cancellation here, so don't await
+        spawn(_finish_stream(stream, db, turn, "".join(parts), completed, model, usage))
 
-    # 7) seed long-term memory
-    await seed_user_memory(db, user_id, [{"role": "user", "content": prompt}])
 
-    return [{"role": "assistant", "content": ai_msg.content}]
+async def _finish_stream(
+    stream,
+    db: Pool,
+    turn: Dict[str, Any],
+    reply: str,
+    completed: bool,
+    model: str,
+    usage=None,
+):
+    metrics.record_usage(model, usage)
+    try:
+        await stream.close()
+    finally:
+        scheduler.release(_reserve(turn), usage.total_tokens if usage else None)
+    await admission.charge(turn["user_id"], usage)
+    if completed and turn["cache_key"] and model == turn["model"]:
+        await completion_cache.set(turn["cache_key"], reply)
+    if reply:
+        await _persist(db, turn, reply)
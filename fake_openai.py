@@ -0,0 +1,157 @@
+"""
+Minimal OpenAI-compatible chat completions server for local testing.
+
+    uvicorn fake_openai:app --port 9000
+    OPENAI_BASE_URL=http://localhost:9000/v1 OPENAI_API_KEY=fake python main.py
+
+Replies are deterministic: the last user message is reflected back. Set
+FAKE_OPENAI_LATENCY (seconds before the first token) and FAKE_OPENAI_TOKEN_RATE
+(tokens per second while streaming) to shape timings.
+
+Errors can be injected to exercise retries: FAKE_OPENAI_RPM enforces a
+requests-per-minute limit with 429s, and FAKE_OPENAI_429_RATE /
+FAKE_OPENAI_5XX_RATE fail that fraction of calls at random.
+FAKE_OPENAI_RETRY_AFTER sets the Retry-After header on 429s.
+"""
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+import zlib
+from collections import deque
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+LATENCY    = float(os.getenv("FAKE_OPENAI_LATENCY", 0.2))
+TOKEN_RATE = float(os.getenv("FAKE_OPENAI_TOKEN_RATE", 50))
+RPM         = int(os.getenv("FAKE_OPENAI_RPM", 0))
+RATE_429    = float(os.getenv("FAKE_OPENAI_429_RATE", 0))
+RATE_5XX    = float(os.getenv("FAKE_OPENAI_5XX_RATE", 0))
+RETRY_AFTER = os.getenv("FAKE_OPENAI_RETRY_AFTER", "1")
+
+_recent: deque = deque()  # request times in the last minute, for FAKE_OPENAI_RPM
+
+app = FastAPI()
+
+
+def _reply(messages: list) -> str:
+    last = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+    return f"You said: {last.strip()[:200]}. What feels most true about that?"
+
+
+def _usage(messages: list, reply: str) -> dict:
+    prompt_tokens = sum(len(m["content"]) // 4 + 4 for m in messages)
+    completion_tokens = len(reply.split())
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def _error(status: int, kind: str, message: str) -> JSONResponse:
+    headers = {"retry-after": RETRY_AFTER} if status == 429 else {}
+    return JSONResponse(
+        {"error": {"message": message, "type": kind, "param": None, "code": None}},
+        status_code=status,
+        headers=headers,
+    )
+
+
+def _injected_error():
+    now = time.monotonic()
+    while _recent and _recent[0] < now - 60:
+        _recent.popleft()
+    if RPM and len(_recent) >= RPM:
+        return _error(429, "requests", "Rate limit reached for requests per minute")
+    _recent.append(now)
+    if random.random() < RATE_429:
+        return _error(429, "requests", "Rate limit reached (injected)")
+    if random.random() < RATE_5XX:
+        return _error(500, "server_error", "The server had an error (injected)")
+    return None
+
+
+@app.post("/v1/chat/completions")
+async def completions(request: Request):
+    body = await request.json()
+    error = _injected_error()
+    if error is not None:
+        return error
+    model = body.get("model", "fake")
+    reply = _reply(body["messages"])
+    cid = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    await asyncio.sleep(LATENCY)
+
+    if not body.get("stream"):
+        return {
+            "id": cid,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": reply},
+                "finish_reason": "stop",
+            }],
+            "usage": _usage(body["messages"], reply),
+        }
+
+    async def chunks():
+        def chunk(delta: dict, finish: str | None = None) -> str:
+            return "data: " + json.dumps({
+                "id": cid,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+            }) + "\n\n"
+
+        yield chunk({"role": "assistant", "content": ""})
+        words = reply.split(" ")
+        for i, word in enumerate(words):
+            yield chunk({"content": word if i == 0 else " " + word})
+            if TOKEN_RATE > 0:
+                await asyncio.sleep(1 / TOKEN_RATE)
+        yield chunk({}, "stop")
+        if (body.get("stream_options") or {}).get("include_usage"):
+            yield "data: " + json.dumps({
+                "id": cid,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [],
+                "usage": _usage(body["messages"], reply),
+            }) + "\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(chunks(), media_type="text/event-stream")
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    data = []
+    for i, text in enumerate(inputs):
+        # deterministic pseudo-embedding: hashed words, 64 dims
+        vec = [0.0] * 64
+        for word in text.lower().split():
+            h = zlib.crc32(word.encode("utf-8"))
+            vec[h % 64] += 1.0
+        data.append({"object": "embedding", "index": i, "embedding": vec})
+    return {
+        "object": "list",
+        "data": data,
+        "model": body.get("model", "fake"),
+        "usage": {"prompt_tokens": 0, "total_tokens": 0},
+    }
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="127.0.0.1", port=int(os.getenv("PORT", 9000)))
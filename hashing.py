@@ -0,0 +1,65 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+# === CONFIG ===
+# bcrypt releases the GIL, so a small thread pool gives real parallelism
+# without blocking the event loop.
+HASH_WORKERS     = int(os.getenv("HASH_WORKERS", min(4, os.cpu_count() or 1)))
+# Jobs allowed to wait for a worker before new ones are refused with a 503.
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", 32))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+_executor   = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="bcrypt")
+_in_flight  = 0
+
+
+def _release():
+    global _in_flight
+    _in_flight -= 1
+
+
+def _release_from(loop):
+    # runs on the worker thread; the loop may be gone after shutdown
+    if not loop.is_closed():
+        loop.call_soon_threadsafe(_release)
+
+
+async def _run(fn, *args):
+    global _in_flight
+    if _in_flight >= HASH_WORKERS + HASH_QUEUE_LIMIT:
+        raise HTTPException(503, "Server busy, try again shortly", headers={"Retry-After": "1"})
+    loop = asyncio.get_running_loop()
+    _in_flight += 1
+    # the slot is held until the job ends, even when the caller stops waiting
+    # (client gone), so the bound holds during a login storm
+    future = _executor.submit(fn, *args)
+    future.add_done_callback(lambda _: _release_from(loop))
+    return await asyncio.wrap_future(future)
+
+
+def queue_depth() -> int:
+    """
+    Hashing jobs waiting for a worker.
+    """
+    return max(0, _in_flight - HASH_WORKERS)
+
+
+async def hash_password(password: str) -> str:
+    return await _run(pwd_context.hash, password)
+
+
+async def verify_password(password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+    """
+    Check `password`. Returns (ok, new_hash); new_hash is set when the stored
+    hash uses outdated settings and should be replaced.
+    """
+    return await _run(pwd_context.verify_and_update, password, password_hash)
+
+
+def shutdown():
+    _executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,83 @@
+import os
+from typing import List, Dict, Any, Awaitable, Callable, Optional, Tuple
+
+# === CONFIG ===
+# Token budget for the chat history sent upstream on each turn (summary included).
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", 3000))
+# When the window overflows, older turns are folded into the summary until the
+# remaining tail fits in this fraction of the budget, so we summarise every few
+# turns instead of on every single one.
+HISTORY_KEEP_RATIO   = float(os.getenv("HISTORY_KEEP_RATIO", 0.5))
+# Hard cap on rows read per turn, whatever the budget.
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", 200))
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except ImportError:  # rough estimate is good enough for budgeting
+    _encoding = None
+
+Summarizer = Callable[[str, List[Dict[str, str]]], Awaitable[str]]
+
+
+# === TOKEN COUNTING ===
+def count_tokens(text: str) -> int:
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return max(1, len(text) // 4)
+
+def message_tokens(message: Dict[str, Any]) -> int:
+    # ~4 tokens of framing per chat message
+    return count_tokens(message["content"]) + 4
+
+
+def _fit(rows: List[Dict[str, Any]], budget: int) -> int:
+    """
+    Number of rows (newest first) that fit in `budget` tokens.
+    """
+    used = 0
+    for i, r in enumerate(rows):
+        used += message_tokens(r)
+        if used > budget:
+            return i
+    return len(rows)
+
+
+# === HISTORY ENGINE ===
+async def build_history(
+    summary: str,
+    rows: List[Dict[str, Any]],
+    summarize: Summarizer,
+) -> Tuple[List[Dict[str, str]], Optional[Tuple[str, int]]]:
+    """
+    Trim a session's history to HISTORY_TOKEN_BUDGET.
+
+    `rows` are the messages newer than the session's summary watermark,
+    newest first (see queries.load_turn_context). When they no longer fit,
+    the oldest turns are folded into the summary so each turn only ever
+    reads O(new messages).
+
+    Returns the history to send upstream and, if the summary changed, the
+    (summary, summarized_through) pair to persist with the turn.
+    """
+    update = None
+    budget = HISTORY_TOKEN_BUDGET - count_tokens(summary)
+    keep = _fit(rows, budget)
+    if keep < len(rows):
+        keep = _fit(rows, int(budget * HISTORY_KEEP_RATIO))
+        folded = rows[keep:][::-1]
+        summary = await summarize(
+            summary, [{"role": r["role"], "content": r["content"]} for r in folded]
+        )
+        update = (summary, folded[-1]["id"])
+
+    history = [{"role": r["role"], "content": r["content"]} for r in reversed(rows[:keep])]
+    if summary:
+        history.insert(
+            0,
+            {
+                "role": "system",
+                "content": "Summary of the earlier conversation:\n\n" + summary,
+            },
+        )
+    return history, update
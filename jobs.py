@@ -0,0 +1,192 @@
+import asyncio
+import json
+import logging
+import os
+import random
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from asyncpg import Pool
+
+log = logging.getLogger(__name__)
+
+# === CONFIG ===
+JOBS_WORKERS     = int(os.getenv("JOBS_WORKERS", 2))
+JOBS_BATCH_SIZE  = int(os.getenv("JOBS_BATCH_SIZE", 50))
+JOBS_MAX_RETRIES = int(os.getenv("JOBS_MAX_RETRIES", 5))
+JOBS_QUEUE_LIMIT = int(os.getenv("JOBS_QUEUE_LIMIT", 10000))
+# "1" stores jobs in the Postgres jobs table so they survive restarts and are
+# shared by every worker process; otherwise they live in this process only.
+JOBS_DURABLE     = os.getenv("JOBS_DURABLE", "0") == "1"
+# How often durable workers look for jobs enqueued by other processes.
+JOBS_POLL_SECONDS = float(os.getenv("JOBS_POLL_SECONDS", 1.0))
+# How long shutdown waits for queued jobs before giving up.
+JOBS_DRAIN_SECONDS = float(os.getenv("JOBS_DRAIN_SECONDS", 10.0))
+
+# handler(db, payloads) processes a whole batch of jobs with the same name
+Handler = Callable[[Pool, List[Dict[str, Any]]], Awaitable[None]]
+
+
+def backoff(attempt: int) -> float:
+    return min(60.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+class JobQueue:
+    """
+    Background work queue for things the user doesn't need to wait for.
+
+    Jobs are (name, JSON-able payload). Workers pull up to JOBS_BATCH_SIZE at a
+    time, group them by name and hand each group to its handler in a single
+    call. Failed groups are retried with jittered exponential backoff and
+    dropped (and logged) after JOBS_MAX_RETRIES.
+    """
+
+    def __init__(self, durable: bool = JOBS_DURABLE):
+        self.durable = durable
+        self.handlers: Dict[str, Handler] = {}
+        self.db: Optional[Pool] = None
+        self._queue: asyncio.Queue = asyncio.Queue(JOBS_QUEUE_LIMIT)
+        self._wake = asyncio.Event()
+        self._workers: List[asyncio.Task] = []
+        self._retries: set = set()
+        self._stopping = False
+
+    def register(self, name: str, handler: Handler):
+        self.handlers[name] = handler
+
+    async def enqueue(self, name: str, payload: Dict[str, Any]):
+        if name not in self.handlers:
+            raise KeyError(f"No handler for job {name!r}")
+        if self.durable:
+            await self.db.execute(
+                "INSERT INTO jobs (name, payload) VALUES ($1, $2)",
+                name, json.dumps(payload),
+            )
+            self._wake.set()
+        else:
+            await self._queue.put((name, payload, 0))
+
+    def depth(self) -> int:
+        return self._queue.qsize() + len(self._retries)
+
+    # === LIFECYCLE ===
+    def start(self, db: Pool, workers: int = JOBS_WORKERS):
+        self.db = db
+        self._stopping = False
+        loop = self._durable_worker if self.durable else self._memory_worker
+        self._workers = [asyncio.create_task(loop()) for _ in range(workers)]
+
+    async def drain(self, timeout: float = JOBS_DRAIN_SECONDS):
+        """
+        Stop taking new work once what is queued here has run (or `timeout`
+        passes), then stop the workers. Durable jobs left behind are picked
+        up by the next process.
+        """
+        self._stopping = True
+        self._wake.set()
+        if self.durable and self._workers:
+            # workers exit after their current batch
+            await asyncio.wait(self._workers, timeout=timeout)
+        else:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                log.warning("job queue drain timed out with %d jobs left", self._queue.qsize())
+        if self._retries:
+            log.warning("abandoning %d job retries on shutdown", len(self._retries))
+        for task in [*self._workers, *self._retries]:
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._retries, return_exceptions=True)
+        self._workers = []
+
+    # === IN-MEMORY ===
+    async def _memory_worker(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < JOBS_BATCH_SIZE and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                groups = defaultdict(list)
+                for name, payload, attempt in batch:
+                    groups[(name, attempt)].append(payload)
+                for (name, attempt), payloads in groups.items():
+                    try:
+                        await self.handlers[name](self.db, payloads)
+                    except Exception:
+                        log.exception("job %s failed (attempt %d)", name, attempt + 1)
+                        self._retry(name, payloads, attempt + 1)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _retry(self, name: str, payloads: List[Dict[str, Any]], attempt: int):
+        if attempt >= JOBS_MAX_RETRIES:
+            log.error("dropping %d %s job(s) after %d attempts", len(payloads), name, attempt)
+            return
+
+        async def later():
+            await asyncio.sleep(backoff(attempt))
+            for payload in payloads:
+                await self._queue.put((name, payload, attempt))
+
+        task = asyncio.create_task(later())
+        self._retries.add(task)
+        task.add_done_callback(self._retries.discard)
+
+    # === DURABLE ===
+    async def _durable_worker(self):
+        while not self._stopping:
+            try:
+                claimed = await self._run_durable_batch()
+            except Exception:
+                log.exception("durable job batch failed")
+                claimed = 0
+            if not claimed:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), JOBS_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _run_durable_batch(self) -> int:
+        async with self.db.acquire() as conn:
+            async with conn.transaction():
+                # rows stay locked (and invisible to other workers) until commit
+                rows = await conn.fetch(
+                    """
+                    SELECT id, name, payload, attempts FROM jobs
+                     WHERE run_after <= now()
+                     ORDER BY id
+                     LIMIT $1
+                     FOR UPDATE SKIP LOCKED
+                    """,
+                    JOBS_BATCH_SIZE,
+                )
+                groups = defaultdict(list)
+                for r in rows:
+                    groups[r["name"]].append(r)
+                for name, group in groups.items():
+                    ids = [r["id"] for r in group]
+                    try:
+                        await self.handlers[name](self.db, [json.loads(r["payload"]) for r in group])
+                    except Exception:
+                        attempt = max(r["attempts"] for r in group) + 1
+                        log.exception("job %s failed (attempt %d)", name, attempt)
+                        if attempt >= JOBS_MAX_RETRIES:
+                            log.error("dropping %d %s job(s) after %d attempts", len(ids), name, attempt)
+                        else:
+                            await conn.execute(
+                                """
+                                UPDATE jobs
+                                   SET attempts = $2,
+                                       run_after = now() + make_interval(secs => $3)
+                                 WHERE id = ANY($1::bigint[])
+                                """,
+                                ids, attempt, backoff(attempt),
+                            )
+                            continue
+                    await conn.execute("DELETE FROM jobs WHERE id = ANY($1::bigint[])", ids)
+        return len(rows)
+
+
+queue = JobQueue()
@@ -0,0 +1,304 @@
+"""
+LLM backends and routing.
+
+Every chat completion goes through `router`, by tier:
+
+    chat     the reply to a turn (CHAT_MODEL)
+    summary  folding old history into the session summary (SUMMARY_MODEL)
+    title    naming a session (TITLE_MODEL)
+
+Each tier has an ordered list of backends (LLM_<TIER>_BACKENDS, default
+LLM_BACKENDS). A backend that still fails after the scheduler's retries is
+skipped for LLM_FAILOVER_COOLDOWN seconds and the call moves on to the next
+one, e.g. from OpenAI to a llama.cpp server:
+
+    LLM_BACKENDS=openai,local LOCAL_LLM_BASE_URL=http://127.0.0.1:8080/v1
+
+Backends:
+
+    openai  the OpenAI API, or any compatible server at OPENAI_BASE_URL
+    local   an OpenAI-compatible server on this machine (llama.cpp's
+            llama-server, vLLM, Ollama...) serving LOCAL_LLM_MODEL
+    fake    in-process and deterministic: replies reflect the last user
+            message, so the app runs (and benchmarks) with no network
+
+Clients are created on first use, each with its own connection pool
+(LLM_MAX_CONNECTIONS) and timeouts, so importing this needs no API key.
+"""
+import asyncio
+import logging
+import os
+import time
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+import openai
+from fastapi import HTTPException
+
+from history import count_tokens
+from scheduler import UpstreamError, scheduler
+
+log = logging.getLogger(__name__)
+
+# === CONFIG ===
+# Comma-separated backends tried in order, for every tier unless overridden.
+LLM_BACKENDS          = os.getenv("LLM_BACKENDS", "openai")
+LLM_CHAT_BACKENDS     = os.getenv("LLM_CHAT_BACKENDS", LLM_BACKENDS)
+LLM_SUMMARY_BACKENDS  = os.getenv("LLM_SUMMARY_BACKENDS", LLM_BACKENDS)
+LLM_TITLE_BACKENDS    = os.getenv("LLM_TITLE_BACKENDS", LLM_SUMMARY_BACKENDS)
+# Memory embeddings (memory.MEMORY_EMBEDDER=openai) come from one backend.
+LLM_EMBED_BACKEND     = os.getenv("LLM_EMBED_BACKEND", LLM_BACKENDS.split(",")[0].strip())
+# Seconds a failed backend is passed over while another one is left to try.
+LLM_FAILOVER_COOLDOWN = float(os.getenv("LLM_FAILOVER_COOLDOWN", 30))
+# Connections each backend's client keeps open (and at most opens).
+LLM_MAX_CONNECTIONS   = int(os.getenv("LLM_MAX_CONNECTIONS", 64))
+LLM_CONNECT_TIMEOUT   = float(os.getenv("LLM_CONNECT_TIMEOUT", 5))
+
+OPENAI_API_KEY        = os.getenv("OPENAI_API_KEY")
+# OPENAI_BASE_URL points the client at a compatible server, e.g. fake_openai.py.
+OPENAI_BASE_URL       = os.getenv("OPENAI_BASE_URL")
+OPENAI_TIMEOUT        = float(os.getenv("OPENAI_TIMEOUT", 60))
+CHAT_MODEL            = os.getenv("CHAT_MODEL", "gpt-3.5-turbo")
+SUMMARY_MODEL         = os.getenv("SUMMARY_MODEL", "gpt-3.5-turbo")
+TITLE_MODEL           = os.getenv("TITLE_MODEL", SUMMARY_MODEL)
+
+LOCAL_LLM_BASE_URL    = os.getenv("LOCAL_LLM_BASE_URL", "http://127.0.0.1:8080/v1")
+LOCAL_LLM_API_KEY     = os.getenv("LOCAL_LLM_API_KEY", "local")
+LOCAL_LLM_MODEL       = os.getenv("LOCAL_LLM_MODEL", "local")
+# CPU inference is slow; this is per request, not per token.
+LOCAL_LLM_TIMEOUT     = float(os.getenv("LOCAL_LLM_TIMEOUT", 300))
+
+# Seconds before the fake backend answers, and its streaming speed.
+FAKE_LLM_LATENCY      = float(os.getenv("FAKE_LLM_LATENCY", 0))
+FAKE_LLM_TOKEN_RATE   = float(os.getenv("FAKE_LLM_TOKEN_RATE", 0))
+
+TIERS = ("chat", "summary", "title")
+
+
+# === BACKENDS ===
+class Backend:
+    """
+    An OpenAI-compatible server. The client (and its connection pool) is
+    created on first use.
+    """
+
+    # True when nothing leaves the process (memory then embeds locally too)
+    offline = False
+
+    def __init__(self, name: str, models: Dict[str, str], base_url: Optional[str],
+                 api_key: Optional[str], timeout: float):
+        self.name = name
+        self.models = models
+        self.base_url = base_url
+        self.api_key = api_key
+        self.timeout = timeout
+        self._client: Optional[openai.AsyncOpenAI] = None
+
+    def configured(self) -> bool:
+        return bool(self.api_key)
+
+    @property
+    def client(self) -> openai.AsyncOpenAI:
+        if self._client is None:
+            if not self.api_key:
+                raise RuntimeError(f"LLM backend {self.name!r} has no API key")
+            # retries are left to the scheduler, which knows about the shared rate limit
+            self._client = openai.AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=self.base_url,
+                max_retries=0,
+                timeout=httpx.Timeout(self.timeout, connect=LLM_CONNECT_TIMEOUT),
+                http_client=openai.DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                    ),
+                ),
+            )
+        return self._client
+
+    async def create(self, tier: str, messages: List[Dict[str, str]], **kwargs) -> Any:
+        return await self.client.chat.completions.create(model=self.models[tier], messages=messages, **kwargs)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+class _FakeStream:
+    """
+    Async iterator of chat completion chunks, like openai.AsyncStream.
+    """
+
+    def __init__(self, words: List[str], model: str, usage: Any, include_usage: bool):
+        self._words = words
+        self._model = model
+        self._usage = usage
+        self._include_usage = include_usage
+
+    def __aiter__(self) -> AsyncIterator[Any]:
+        return self._chunks()
+
+    async def _chunks(self) -> AsyncIterator[Any]:
+        for i, word in enumerate(self._words):
+            if FAKE_LLM_TOKEN_RATE > 0:
+                await asyncio.sleep(1 / FAKE_LLM_TOKEN_RATE)
+            delta = SimpleNamespace(content=word if i == 0 else " " + word, role="assistant")
+            yield SimpleNamespace(model=self._model, usage=None,
+                                  choices=[SimpleNamespace(index=0, delta=delta, finish_reason=None)])
+        if self._include_usage:
+            yield SimpleNamespace(model=self._model, usage=self._usage, choices=[])
+
+    async def close(self):
+        pass
+
+
+class FakeBackend(Backend):
+    """
+    Deterministic replies computed in-process: nothing to configure, no
+    network, same answer for the same messages.
+    """
+
+    offline = True
+
+    def __init__(self, name: str = "fake"):
+        super().__init__(name, {tier: "fake" for tier in TIERS}, None, None, 0)
+
+    def configured(self) -> bool:
+        return True
+
+    @staticmethod
+    def reply(tier: str, messages: List[Dict[str, str]]) -> str:
+        last = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+        if tier == "title":
+            # the title prompt is "User: <prompt>\n\nAssistant: <reply>"
+            return " ".join(last.removeprefix("User:").split()[:5]) or "Conversation"
+        if tier == "summary":
+            return " ".join(last.split()[:200])
+        return f"You said: {' '.join(last.split())}. What feels most true about that?"
+
+    async def create(self, tier: str, messages: List[Dict[str, str]], stream: bool = False,
+                     stream_options: Optional[Dict[str, Any]] = None, **kwargs) -> Any:
+        if FAKE_LLM_LATENCY > 0:
+            await asyncio.sleep(FAKE_LLM_LATENCY)
+        text = self.reply(tier, messages)
+        prompt_tokens = sum(count_tokens(m["content"]) for m in messages)
+        completion_tokens = count_tokens(text)
+        usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                total_tokens=prompt_tokens + completion_tokens)
+        if stream:
+            return _FakeStream(text.split(), "fake", usage, bool((stream_options or {}).get("include_usage")))
+        message = SimpleNamespace(role="assistant", content=text)
+        return SimpleNamespace(model="fake", usage=usage,
+                               choices=[SimpleNamespace(index=0, message=message, finish_reason="stop")])
+
+
+def _builtin_backends() -> Dict[str, Backend]:
+    return {
+        "openai": Backend(
+            "openai", {"chat": CHAT_MODEL, "summary": SUMMARY_MODEL, "title": TITLE_MODEL},
+            OPENAI_BASE_URL, OPENAI_API_KEY, OPENAI_TIMEOUT,
+        ),
+        "local": Backend(
+            "local", {tier: LOCAL_LLM_MODEL for tier in TIERS},
+            LOCAL_LLM_BASE_URL, LOCAL_LLM_API_KEY, LOCAL_LLM_TIMEOUT,
+        ),
+        "fake": FakeBackend(),
+    }
+
+
+def _route(spec: str, backends: Dict[str, Backend]) -> List[Backend]:
+    names = [name.strip() for name in spec.split(",") if name.strip()]
+    unknown = [name for name in names if name not in backends]
+    if unknown or not names:
+        raise RuntimeError(f"Unknown LLM backend in {spec!r}; choose from {', '.join(backends)}")
+    return [backends[name] for name in names]
+
+
+# === ROUTING ===
+class Router:
+    """
+    Sends each call to the first healthy, configured backend of its tier,
+    failing over down the list.
+    """
+
+    def __init__(self, backends: Dict[str, Backend], routes: Dict[str, List[Backend]]):
+        self.backends = backends
+        self.routes = routes
+        self._down_until: Dict[str, float] = {}
+        self.counters = {"calls": 0, "failovers": 0, "failed": 0}
+
+    def model(self, tier: str) -> str:
+        """
+        The model the tier's first backend uses (what cache keys are made of).
+        """
+        return self.routes[tier][0].models[tier]
+
+    def _candidates(self, tier: str) -> List[Backend]:
+        configured = [b for b in self.routes[tier] if b.configured()]
+        if not configured:
+            raise HTTPException(503, f"No LLM backend configured for {tier}")
+        now = time.monotonic()
+        healthy = [b for b in configured if self._down_until.get(b.name, 0) <= now]
+        # with every backend cooling down, try them all anyway
+        return healthy or configured
+
+    async def open(self, tier: str, user_id: Any, tokens: int, messages: List[Dict[str, str]],
+                   **kwargs) -> Tuple[Any, str]:
+        """
+        scheduler.open() on the tier's backends in turn. Returns the response
+        (or stream; the caller releases the scheduler slot) and the model
+        that produced it.
+        """
+        candidates = self._candidates(tier)
+        self.counters["calls"] += 1
+        for i, backend in enumerate(candidates):
+            try:
+                response = await scheduler.open(
+                    user_id, tokens, lambda: backend.create(tier, messages, **kwargs)
+                )
+                self._down_until.pop(backend.name, None)
+                return response, backend.models[tier]
+            # only upstream failures count against a backend: the
+            # scheduler's own refusals (queue full, wait timeout) propagate
+            except (UpstreamError, openai.APIError) as e:
+                # a request the server rejects would be rejected anywhere
+                if not isinstance(e, openai.BadRequestError):
+                    self._down_until[backend.name] = time.monotonic() + LLM_FAILOVER_COOLDOWN
+                if i + 1 == len(candidates):
+                    self.counters["failed"] += 1
+                    raise
+                self.counters["failovers"] += 1
+                log.warning("LLM backend %s failed for %s (%s), trying %s",
+                            backend.name, tier, e, candidates[i + 1].name)
+
+    async def call(self, tier: str, user_id: Any, tokens: int, messages: List[Dict[str, str]],
+                   **kwargs) -> Tuple[Any, str]:
+        """
+        open() and release the slot, settling tokens against the usage.
+        """
+        response, model = await self.open(tier, user_id, tokens, messages, **kwargs)
+        usage = getattr(response, "usage", None)
+        scheduler.release(tokens, getattr(usage, "total_tokens", None))
+        return response, model
+
+    async def close(self):
+        for backend in self.backends.values():
+            await backend.close()
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            **self.counters,
+            "backends_down": sum(1 for until in self._down_until.values() if until > now),
+        }
+
+
+backends = _builtin_backends()
+embed_backend = _route(LLM_EMBED_BACKEND, backends)[0]
+router = Router(backends, {
+    "chat": _route(LLM_CHAT_BACKENDS, backends),
+    "summary": _route(LLM_SUMMARY_BACKENDS, backends),
+    "title": _route(LLM_TITLE_BACKENDS, backends),
+})
@@ -0,0 +1,259 @@
+import asyncio
+import os
+import re
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+import openai
+from asyncpg import Pool
+
+from history import count_tokens
+from llm import LLM_FAILOVER_COOLDOWN
+from queries import memories_since, memory_epoch
+from scheduler import UpstreamError, scheduler
+
+# === CONFIG ===
+# "openai" embeds through an OpenAI-compatible API (llm.LLM_EMBED_BACKEND);
+# "hashing" is a deterministic, fully local embedder (no network), used for
+# tests and offline runs, and whenever that backend is the fake one or has
+# no API key.
+MEMORY_EMBEDDER   = os.getenv("MEMORY_EMBEDDER", "openai")
+MEMORY_EMBED_MODEL = os.getenv("MEMORY_EMBED_MODEL", "text-embedding-3-small")
+MEMORY_TOP_K      = int(os.getenv("MEMORY_TOP_K", 5))
+MEMORY_MIN_SCORE  = float(os.getenv("MEMORY_MIN_SCORE", 0.0))
+# Users whose vectors are kept in memory (least recently used are dropped).
+MEMORY_INDEX_USERS = int(os.getenv("MEMORY_INDEX_USERS", 1000))
+# Rows without a vector for the current embedder are backfilled this many at a time.
+MEMORY_BACKFILL_BATCH = int(os.getenv("MEMORY_BACKFILL_BATCH", 256))
+
+_WORD = re.compile(r"[a-z0-9']+")
+
+
+# === EMBEDDERS ===
+class HashingEmbedder:
+    """
+    Feature-hashed bag of words and bigrams, L2-normalised. Cheap and
+    deterministic across processes, but only lexical.
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def _embed_one(self, text: str) -> np.ndarray:
+        v = np.zeros(self.dim, dtype=np.float32)
+        words = _WORD.findall(text.lower())
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            h = zlib.crc32(feature.encode("utf-8"))
+            v[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        norm = np.linalg.norm(v)
+        return v / norm if norm else v
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        return np.stack([self._embed_one(t) for t in texts])
+
+
+class OpenAIEmbedder:
+    """
+    Embeddings from one backend, within the scheduler's RPM/TPM budget (and
+    with its retries). No failover: another backend's vectors wouldn't be
+    comparable with the stored ones. After a failure, calls fail fast for
+    LLM_FAILOVER_COOLDOWN seconds so callers don't each wait out retries.
+    """
+
+    def __init__(self, backend, model: str = MEMORY_EMBED_MODEL):
+        # an llm.Backend: its client is only created on the first embedding
+        self.backend = backend
+        self.model = model
+        self.name = f"{backend.name}:{model}"
+        self._down_until = 0.0
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        if time.monotonic() < self._down_until:
+            raise RuntimeError(f"embedding backend {self.backend.name!r} is cooling down")
+        tokens = sum(count_tokens(t) for t in texts)
+        try:
+            response = await scheduler.call(
+                "embeddings", tokens,
+                lambda: self.backend.client.embeddings.create(model=self.model, input=texts),
+            )
+        except (UpstreamError, openai.APIError):
+            self._down_until = time.monotonic() + LLM_FAILOVER_COOLDOWN
+            raise
+        m = np.array([d.embedding for d in response.data], dtype=np.float32)
+        return m / np.maximum(np.linalg.norm(m, axis=1, keepdims=True), 1e-12)
+
+
+def make_embedder(backend):
+    # without a key the backend can't embed at all; stay local
+    if MEMORY_EMBEDDER == "hashing" or backend.offline or not backend.configured():
+        return HashingEmbedder()
+    if MEMORY_EMBEDDER == "openai":
+        return OpenAIEmbedder(backend)
+    raise RuntimeError(f"Unknown MEMORY_EMBEDDER: {MEMORY_EMBEDDER}")
+
+
+# === VECTOR INDEX ===
+class _UserVectors:
+    """
+    Growable float32 matrix of one user's memory vectors.
+    """
+
+    def __init__(self):
+        self.vectors: Optional[np.ndarray] = None
+        self.contents: List[str] = []
+        self.size = 0
+        self.max_id = 0
+        self.epoch = 0
+        self.backfilled = False
+        self.lock = asyncio.Lock()
+
+    def append(self, ids: List[int], contents: List[str], vectors: np.ndarray):
+        need = self.size + len(ids)
+        if self.vectors is None or need > len(self.vectors):
+            grown = np.empty((max(need, 2 * self.size, 64), vectors.shape[1]), dtype=np.float32)
+            if self.size:
+                grown[: self.size] = self.vectors[: self.size]
+            self.vectors = grown
+        self.vectors[self.size:need] = vectors
+        self.contents.extend(contents)
+        self.size = need
+        self.max_id = max(self.max_id, max(ids))
+
+
+class MemoryIndex:
+    """
+    Per-user in-process vector index over the memories table.
+
+    Vectors are computed once at write time and stored with the row
+    (float32 bytes). The index loads a user's vectors lazily and afterwards
+    only reads rows newer than the last id it has seen, so it stays current
+    across workers. On the reflect path that read rides along with the turn
+    context query (queries.load_turn_context). Consolidation deletes rows,
+    which an append-only index can't follow: it bumps the user's epoch and
+    the index reloads the user when it sees a new one (sync()).
+    """
+
+    def __init__(self, embedder):
+        self.embedder = embedder
+        self._users: "OrderedDict[int, _UserVectors]" = OrderedDict()
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        return await self.embedder.embed(texts)
+
+    def encode(self, vector: np.ndarray) -> bytes:
+        return vector.astype(np.float32).tobytes()
+
+    async def _backfill(self, db: Pool, user_id: int):
+        # rows written before embedding existed, or by a different embedder
+        while True:
+            rows = await db.fetch(
+                """
+                SELECT id, content FROM memories
+                 WHERE user_id=$1 AND embedding_model IS DISTINCT FROM $2
+                 ORDER BY id LIMIT $3
+                """,
+                user_id, self.embedder.name, MEMORY_BACKFILL_BATCH,
+            )
+            if not rows:
+                return
+            vectors = await self.embed([r["content"] for r in rows])
+            await db.executemany(
+                "UPDATE memories SET embedding=$1, embedding_model=$2 WHERE id=$3",
+                [(self.encode(v), self.embedder.name, r["id"]) for r, v in zip(rows, vectors)],
+            )
+
+    async def prepare(self, db: Pool, user_id: int) -> int:
+        """
+        Make sure the user's index exists (backfilling vectors on first use)
+        and return the highest memory id it holds. Fetch newer rows from
+        there and pass them to ingest().
+        """
+        entry = self._users.get(user_id)
+        if entry is None:
+            entry = self._users[user_id] = _UserVectors()
+            if len(self._users) > MEMORY_INDEX_USERS:
+                self._users.popitem(last=False)
+        self._users.move_to_end(user_id)
+        if not entry.backfilled:
+            async with entry.lock:
+                if not entry.backfilled:
+                    await self._backfill(db, user_id)
+                    entry.backfilled = True
+        return entry.max_id
+
+    def ingest(self, user_id: int, rows: List[Any]):
+        """
+        Add (id, content, embedding) rows, ordered by id. Rows the index
+        already holds (e.g. fetched by a concurrent request) are skipped.
+        """
+        entry = self._users.get(user_id)
+        if entry is None:
+            return
+        rows = [r for r in rows if r["id"] > entry.max_id]
+        if rows:
+            entry.append(
+                [r["id"] for r in rows],
+                [r["content"] for r in rows],
+                np.frombuffer(b"".join(r["embedding"] for r in rows), dtype=np.float32)
+                  .reshape(len(rows), -1),
+            )
+
+    async def sync(self, db: Pool, user_id: int, rows: List[Any], epoch: int):
+        """
+        ingest() rows read at consolidation `epoch`, reloading the user's
+        vectors instead when they were read at an older one.
+        """
+        entry = self._users.get(user_id)
+        if entry is None:
+            return
+        if entry.max_id and entry.epoch != epoch:
+            # rows were merged away or evicted since
+            fresh = self._users[user_id] = _UserVectors()
+            fresh.backfilled = True
+            rows = await memories_since(db, user_id, 0, self.embedder.name)
+            entry = fresh
+        entry.epoch = epoch
+        self.ingest(user_id, rows)
+
+    def query(
+        self,
+        user_id: int,
+        vectors: np.ndarray,
+        k: int = MEMORY_TOP_K,
+    ) -> List[List[Tuple[float, str]]]:
+        """
+        Top-k memories for each query vector as (score, content), best first.
+        """
+        entry = self._users.get(user_id)
+        if entry is None or not entry.size or not len(vectors):
+            return [[] for _ in range(len(vectors))]
+        scores = entry.vectors[: entry.size] @ vectors.T  # (memories, queries)
+        k = min(k, entry.size)
+        top = np.argpartition(-scores, k - 1, axis=0)[:k]
+        results = []
+        for j in range(len(vectors)):
+            col = top[:, j]
+            col = col[np.argsort(-scores[col, j])]
+            results.append([
+                (float(scores[i, j]), entry.contents[i])
+                for i in col if scores[i, j] >= MEMORY_MIN_SCORE
+            ])
+        return results
+
+    async def search(
+        self,
+        db: Pool,
+        user_id: int,
+        queries: List[str],
+        k: int = MEMORY_TOP_K,
+    ) -> List[List[Tuple[float, str]]]:
+        since = await self.prepare(db, user_id)
+        epoch = await memory_epoch(db, user_id)
+        await self.sync(db, user_id, await memories_since(db, user_id, since, self.embedder.name), epoch)
+        if not queries:
+            return []
+        return self.query(user_id, await self.embed(queries), k)
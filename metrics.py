@@ -0,0 +1,318 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+log = logging.getLogger(__name__)
+trace_log = logging.getLogger("trace")
+
+# === CONFIG ===
+# Stage timers, query timing and pool gauges. Cheap enough to leave on.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# "1" logs one JSON line per request (logger "trace") with its stage timings,
+# query count and time, pool wait and upstream token usage.
+TRACE_LOG       = os.getenv("TRACE_LOG", "0") == "1"
+# "1" returns each request's query count in an X-DB-Queries header (see bench/load.py).
+DB_QUERY_HEADER = os.getenv("DB_QUERY_HEADER", "0") == "1"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+Labels = Tuple[str, ...]
+
+
+# === REGISTRY ===
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _series(name: str, labelnames: Labels, labels: Labels, extra: str = "") -> str:
+    pairs = [f'{k}="{_escape(str(v))}"' for k, v in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return f"{name}{{{','.join(pairs)}}}" if pairs else name
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Labels = ()):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self._values: Dict[Labels, float] = {}
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, *labels: str):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{_series(self.name, self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Labels = (), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.buckets = tuple(buckets)
+        # per label set: [count per bucket..., count above the last bucket, sum]
+        self._values: Dict[Labels, List[float]] = {}
+        _registry.append(self)
+
+    def observe(self, value: float, *labels: str):
+        counts = self._values.get(labels)
+        if counts is None:
+            counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, counts in self._values.items():
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                total += count
+                le = 'le="+Inf"' if bound == "+Inf" else f'le="{bound}"'
+                lines.append(f"{_series(self.name + '_bucket', self.labelnames, labels, le)} {total}")
+            lines.append(f"{_series(self.name + '_sum', self.labelnames, labels)} {_number(counts[-1])}")
+            lines.append(f"{_series(self.name + '_count', self.labelnames, labels)} {total}")
+        return lines
+
+
+class StatsGauges:
+    """
+    Exposes a component's stats() dict as gauges named <prefix>_<key>,
+    read at scrape time. Non-numeric values are skipped.
+    """
+
+    def __init__(self, prefix: str, stats: Callable[[], Dict[str, Any]]):
+        self.prefix, self.stats = prefix, stats
+        _registry.append(self)
+
+    def render(self) -> List[str]:
+        lines = []
+        try:
+            stats = self.stats()
+        except Exception:
+            log.warning("stats for %s failed", self.prefix, exc_info=True)
+            return lines
+        for key, value in stats.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = f"{self.prefix}_{key}"
+            lines += [f"# TYPE {name} gauge", f"{name} {_number(value)}"]
+        return lines
+
+
+_registry: List[Any] = []
+
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in _registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+HTTP_SECONDS    = Histogram("http_request_duration_seconds", "Request latency by route.", ("method", "route", "status"))
+STAGE_SECONDS   = Histogram("reflect_stage_duration_seconds", "Time per stage of a chat turn.", ("stage",))
+QUERY_SECONDS   = Histogram("db_query_duration_seconds", "Database query latency by statement kind.", ("kind",))
+QUERY_ERRORS    = Counter("db_query_errors_total", "Database queries that raised.", ("kind",))
+POOL_WAIT       = Histogram("db_pool_acquire_wait_seconds", "Time spent waiting for a pooled connection.")
+LLM_TOKENS      = Counter("llm_tokens_total", "Upstream tokens reported in response usage.", ("model", "kind"))
+
+
+# === REQUEST CONTEXT ===
+# Per-request tally shared by everything the request's task (and tasks it
+# spawns) does; None outside a request.
+_request: ContextVar[Optional[Dict[str, Any]]] = ContextVar("request_metrics", default=None)
+
+
+def _new_request() -> Dict[str, Any]:
+    return {"queries": 0, "db_ms": 0.0, "pool_wait_ms": 0.0, "stages": {}, "tokens": {}}
+
+
+def observe_stage(name: str, seconds: float):
+    if METRICS_ENABLED:
+        STAGE_SECONDS.observe(seconds, name)
+    current = _request.get()
+    if current is not None:
+        current["stages"][name] = round(current["stages"].get(name, 0) + seconds * 1000, 3)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a stage of a chat turn.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+def record_usage(model: str, usage: Any):
+    """
+    Count the tokens from an upstream response's `usage` (may be None).
+    """
+    if usage is None:
+        return
+    prompt, completion = usage.prompt_tokens or 0, usage.completion_tokens or 0
+    if METRICS_ENABLED:
+        LLM_TOKENS.inc(prompt, model, "prompt")
+        LLM_TOKENS.inc(completion, model, "completion")
+    current = _request.get()
+    if current is not None:
+        tokens = current["tokens"]
+        tokens["prompt"] = tokens.get("prompt", 0) + prompt
+        tokens["completion"] = tokens.get("completion", 0) + completion
+
+
+# === DATABASE ===
+def _kind(query: str) -> str:
+    words = query.split(None, 1)
+    return words[0].lower() if words else "empty"
+
+
+async def init_connection(conn):
+    """
+    asyncpg pool `init` hook: time every query on the connection.
+    """
+    if not (METRICS_ENABLED or TRACE_LOG or DB_QUERY_HEADER):
+        return
+    # the pool's reset on release isn't the handler's doing
+    reset_query = conn.get_reset_query()
+
+    def on_query(record):
+        # asyncpg runs query loggers via call_soon, in the querying task's context
+        if record.query == reset_query:
+            return
+        if METRICS_ENABLED:
+            kind = _kind(record.query)
+            QUERY_SECONDS.observe(record.elapsed, kind)
+            if record.exception is not None:
+                QUERY_ERRORS.inc(1, kind)
+        current = _request.get()
+        if current is not None:
+            current["queries"] += 1
+            current["db_ms"] += record.elapsed * 1000
+
+    conn.add_query_logger(on_query)
+
+
+class InstrumentedPool:
+    """
+    Wraps an asyncpg pool to time connection acquisition and expose its
+    saturation. Everything not overridden is delegated to the pool.
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+        self.waiting = 0
+        StatsGauges("db_pool", self.stats)
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    @asynccontextmanager
+    async def acquire(self, timeout: Optional[float] = None):
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            conn = await self._pool.acquire(timeout=timeout)
+        finally:
+            self.waiting -= 1
+            waited = time.perf_counter() - start
+            if METRICS_ENABLED:
+                POOL_WAIT.observe(waited)
+            current = _request.get()
+            if current is not None:
+                current["pool_wait_ms"] += waited * 1000
+        try:
+            yield conn
+        finally:
+            await self._pool.release(conn)
+
+    async def execute(self, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.execute(*args, **kwargs)
+
+    async def executemany(self, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.executemany(*args, **kwargs)
+
+    async def fetch(self, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.fetch(*args, **kwargs)
+
+    async def fetchrow(self, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.fetchrow(*args, **kwargs)
+
+    async def fetchval(self, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.fetchval(*args, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        size, idle = self._pool.get_size(), self._pool.get_idle_size()
+        return {
+            "size": size,
+            "idle": idle,
+            "in_use": size - idle,
+            "max_size": self._pool.get_max_size(),
+            "waiting": self.waiting,
+        }
+
+
+# === HTTP ===
+class MetricsMiddleware:
+    """
+    Times each request by route, and sets up the per-request tally used by
+    the trace log and the X-DB-Queries header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        current = _new_request()
+        _request.set(current)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if DB_QUERY_HEADER:
+                    await asyncio.sleep(0)  # let pending query loggers run
+                    message["headers"] = [
+                        *message.get("headers", []),
+                        (b"x-db-queries", str(current["queries"]).encode()),
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            if METRICS_ENABLED:
+                HTTP_SECONDS.observe(elapsed, scope["method"], route, str(status))
+            if TRACE_LOG:
+                trace_log.info(json.dumps({
+                    "method": scope["method"],
+                    "route": route,
+                    "status": status,
+                    "ms": round(elapsed * 1000, 3),
+                    **{k: round(v, 3) if isinstance(v, float) else v for k, v in current.items()},
+                }))
@@ -0,0 +1,127 @@
+import hashlib
+import importlib
+import os
+import re
+import zlib
+from typing import List, Dict, Any, Tuple
+
+import principles
+import questions
+from history import count_tokens, message_tokens
+
+# === CONFIG ===
+# How many of the deeper questions are offered to the model per turn.
+PROMPT_QUESTIONS = int(os.getenv("PROMPT_QUESTIONS", 5))
+
+_WORD = re.compile(r"[a-z']+")
+_STOPWORDS = frozenset("""
+a about after all am an and any are as at be been but by can did do does doing
+for from had has have how i if in into is it its just me more most my no not
+now of on or our out so some such than that the their them then there these
+they this those to too was we were what when where which who whom why will
+with would you your yours yourself
+""".split())
+
+# === COMPILED STATE ===
+# Rebuilt by load(); read through the module (prompt.STATIC_PROMPT), never
+# imported by name, so a reload is picked up everywhere.
+STATIC_PROMPT  = ""
+STATIC_TOKENS  = 0
+PROMPT_VERSION = ""
+_questions: List[str] = []
+_index: Dict[str, List[int]] = {}
+
+
+def _terms(text: str) -> set:
+    return {
+        w.strip("'") for w in _WORD.findall(text.lower())
+        if len(w) > 2 and w not in _STOPWORDS
+    }
+
+
+def load(reload_sources: bool = False) -> str:
+    """
+    Build the static system prompt and the question index. Returns the new
+    PROMPT_VERSION (a hash of everything that goes upstream verbatim).
+    """
+    global STATIC_PROMPT, STATIC_TOKENS, PROMPT_VERSION, _questions, _index
+    if reload_sources:
+        importlib.reload(principles)
+        importlib.reload(questions)
+
+    static = "\n\n".join([
+        "# — System prompt for AI —",
+        "You are a compassionate, patient, and measured mirror of the user.",
+        "Respond in a neutral, reflective tone, combining empathetic insights and gentle guidance.",
+        "Use no more than one or two open-ended questions per reply.",
+        *principles.principles,
+    ])
+    qs = list(questions.questions)
+    index: Dict[str, List[int]] = {}
+    for i, q in enumerate(qs):
+        for t in _terms(q):
+            index.setdefault(t, []).append(i)
+
+    digest = hashlib.sha256(static.encode("utf-8"))
+    for q in qs:
+        digest.update(b"\0" + q.encode("utf-8"))
+
+    STATIC_PROMPT, STATIC_TOKENS = static, count_tokens(static)
+    _questions, _index = qs, index
+    PROMPT_VERSION = digest.hexdigest()[:12]
+    return PROMPT_VERSION
+
+
+def select_questions(text: str, k: int = PROMPT_QUESTIONS) -> List[str]:
+    """
+    Pick the `k` questions sharing the most terms with `text`. Ties and
+    shortfalls are filled from a rotation seeded by the text, so the choice is
+    stable for a given prompt but varies across prompts.
+    """
+    if k <= 0 or not _questions:
+        return []
+    scores: Dict[int, int] = {}
+    for t in _terms(text):
+        for i in _index.get(t, ()):
+            scores[i] = scores.get(i, 0) + 1
+    seed = " ".join(text.casefold().split())
+    start = zlib.crc32(seed.encode("utf-8")) % len(_questions)
+    ranked = sorted(scores, key=lambda i: (-scores[i], (i - start) % len(_questions)))
+    picked = ranked[:k]
+    i = start
+    while len(picked) < min(k, len(_questions)):
+        if i not in scores:
+            picked.append(i)
+        i = (i + 1) % len(_questions)
+    return [_questions[i] for i in picked]
+
+
+def build_messages(
+    prompt: str,
+    history: List[Dict[str, str]],
+) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+    """
+    Assemble the upstream message list: the byte-stable static prefix first
+    (so upstream prompt caching applies), then history, then this turn's
+    question subset and the user prompt.
+
+    Returns the messages and token counts for the static and dynamic parts.
+    """
+    dynamic = [
+        *history,
+        {
+            "role": "system",
+            "content": "You may ask one of these deeper questions if it feels natural:\n\n"
+            + "\n".join(select_questions(prompt)),
+        },
+        {"role": "user", "content": prompt},
+    ]
+    tokens = {
+        "version": PROMPT_VERSION,
+        "static": STATIC_TOKENS,
+        "dynamic": sum(message_tokens(m) for m in dynamic),
+    }
+    return [{"role": "system", "content": STATIC_PROMPT}, *dynamic], tokens
+
+
+load()
@@ -0,0 +1,411 @@
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from asyncpg import Connection
+
+# SQL lives here as module constants so every call sends byte-identical text
+# and hits asyncpg's per-connection prepared statement cache.
+
+# === TURN CONTEXT ===
+# One round trip for everything a turn reads: the session's options (kind 'o',
+# id = cache_enabled, role = 'archived' when its messages are on disk; no row
+# when it is gone), its summary (kind 's'), the history tail past its
+# watermark and last clear, newest first (kind 'h'; bounded below by the
+# session's creation so only partitions from then on are scanned), the user's
+# memories newer than what the in-process index already holds (kind 'm') and
+# their consolidation epoch (kind 'e', id = epoch; see consolidation.py).
+TURN_CONTEXT_SQL = """
+WITH o AS (
+    SELECT cache_enabled, cleared_through, archived_at, created_at
+      FROM sessions
+     WHERE session_id = $1
+       AND user_id    = $2
+       AND deleted_at IS NULL
+),
+s AS (
+    SELECT summary, summarized_through
+      FROM session_summaries
+     WHERE session_id = $1
+)
+SELECT 'o' AS kind, cache_enabled::int AS id,
+       CASE WHEN archived_at IS NOT NULL THEN 'archived' END AS role,
+       NULL::text AS content, NULL::bytea AS embedding
+  FROM o
+UNION ALL
+SELECT 's', summarized_through, NULL, summary, NULL
+  FROM s
+UNION ALL
+(SELECT 'h', id, role, content, NULL
+   FROM messages
+  WHERE session_id = $1
+    AND user_id    = $2
+    AND id > GREATEST((SELECT summarized_through FROM s), (SELECT cleared_through FROM o), 0)
+    AND created_at >= (SELECT created_at FROM o)
+  ORDER BY id DESC
+  LIMIT $3)
+UNION ALL
+(SELECT 'm', id, NULL, content, embedding
+   FROM memories
+  WHERE user_id = $2
+    AND id > $4
+    AND embedding_model = $5
+  ORDER BY id)
+UNION ALL
+SELECT 'e', epoch, NULL, NULL, NULL
+  FROM memory_consolidation
+ WHERE user_id = $2
+"""
+
+
+async def load_turn_context(
+    conn: Connection,
+    session_id: str,
+    user_id: int,
+    history_limit: int,
+    memories_since: int,
+    embedder_name: str,
+) -> Dict[str, Any]:
+    rows = await conn.fetch(
+        TURN_CONTEXT_SQL,
+        session_id, user_id, history_limit, memories_since, embedder_name,
+    )
+    context: Dict[str, Any] = {
+        "found": False, "archived": False, "cache": False,
+        "summary": "", "history": [], "memories": [], "memory_epoch": 0,
+    }
+    for r in rows:
+        if r["kind"] == "o":
+            context["found"] = True
+            context["archived"] = r["role"] == "archived"
+            context["cache"] = bool(r["id"])
+        elif r["kind"] == "s":
+            context["summary"] = r["content"]
+        elif r["kind"] == "h":
+            context["history"].append({"id": r["id"], "role": r["role"], "content": r["content"]})
+        elif r["kind"] == "e":
+            context["memory_epoch"] = r["id"]
+        else:
+            context["memories"].append(r)
+    context["history"].sort(key=lambda m: m["id"], reverse=True)
+    context["memories"].sort(key=lambda m: m["id"])
+    return context
+
+
+# === TURN WRITE ===
+# Characters of the last message kept on the session for the session list.
+SESSION_PREVIEW_CHARS = 200
+
+# Insert both sides of the turn and update the session's list summary in one
+# statement; the new count tells the caller whether this was the first turn.
+APPEND_TURN_SQL = f"""
+WITH inserted AS (
+    INSERT INTO messages (session_id, user_id, role, content)
+    VALUES ($1, $2, 'user', $3), ($1, $2, 'assistant', $4)
+    RETURNING id
+)
+UPDATE sessions
+   SET updated_at    = now(),
+       message_count = message_count + 2,
+       last_preview  = left($4, {SESSION_PREVIEW_CHARS})
+ WHERE session_id = $1
+   AND user_id    = $2
+RETURNING message_count, title_auto
+"""
+
+SAVE_SUMMARY_SQL = """
+INSERT INTO session_summaries (session_id, summary, summarized_through)
+VALUES ($1, $2, $3)
+ON CONFLICT (session_id) DO UPDATE
+   SET summary            = EXCLUDED.summary,
+       summarized_through = EXCLUDED.summarized_through,
+       updated_at         = now()
+"""
+
+
+async def append_turn(
+    conn: Connection,
+    session_id: str,
+    user_id: int,
+    prompt: str,
+    reply: str,
+    summary: Optional[Tuple[str, int]] = None,
+):
+    """
+    Persist a turn, plus the folded history summary when it changed. Returns
+    the session's (message_count, title_auto), or None if it is gone.
+    """
+    if summary is None:
+        return await conn.fetchrow(APPEND_TURN_SQL, session_id, user_id, prompt, reply)
+    async with conn.transaction():
+        row = await conn.fetchrow(APPEND_TURN_SQL, session_id, user_id, prompt, reply)
+        await conn.execute(SAVE_SUMMARY_SQL, session_id, *summary)
+    return row
+
+
+# === SESSIONS ===
+# One index range (sessions_user_activity_idx) per page: most recently active
+# first, resuming after the previous page's last (updated_at, session_id).
+LIST_SESSIONS_SQL = """
+SELECT session_id, title, message_count, last_preview, created_at, updated_at
+  FROM sessions
+ WHERE user_id = $1
+   AND deleted_at IS NULL
+   AND (updated_at, session_id) < ($2, $3)
+ ORDER BY updated_at DESC, session_id DESC
+ LIMIT $4
+"""
+
+# Only while the title is still automatic: a rename always wins.
+SET_AUTO_TITLE_SQL = """
+UPDATE sessions
+   SET title = $3, title_auto = false
+ WHERE session_id = $1
+   AND user_id    = $2
+   AND title_auto
+"""
+
+# Recount sessions whose messages were written or deleted in bulk (imports,
+# retention); created_at moves back to the oldest message if need be.
+REFRESH_SESSION_SUMMARY_SQL = f"""
+UPDATE sessions s
+   SET message_count = coalesce(m.n, 0),
+       last_preview  = m.preview,
+       title_auto    = s.title = 'New Chat' AND m.n IS NULL,
+       created_at    = least(s.created_at, m.first)
+  FROM unnest($1::uuid[]) AS ids (session_id)
+  LEFT JOIN (
+      SELECT DISTINCT ON (session_id)
+             session_id, count(*) OVER (PARTITION BY session_id) AS n,
+             left(content, {SESSION_PREVIEW_CHARS}) AS preview,
+             min(m.created_at) OVER (PARTITION BY session_id) AS first
+        FROM messages m
+        JOIN sessions x USING (session_id)
+       WHERE m.session_id = ANY($1::uuid[])
+         AND m.id > x.cleared_through
+       ORDER BY session_id, m.created_at DESC, m.id DESC
+  ) m ON m.session_id = ids.session_id
+ WHERE s.session_id = ids.session_id
+"""
+
+
+async def list_sessions(
+    conn: Connection,
+    user_id: int,
+    limit: int,
+    after: Optional[Tuple[Any, Any]] = None,
+) -> List[Any]:
+    """
+    A page of the user's sessions; `after` is the previous page's last
+    (updated_at, session_id).
+    """
+    updated_at, session_id = after or (datetime.max, UUID(int=(1 << 128) - 1))
+    return await conn.fetch(LIST_SESSIONS_SQL, user_id, updated_at, session_id, limit)
+
+
+async def delete_session(conn: Connection, session_id: str, user_id: int):
+    # soft: lifecycle.py purges the messages in batches, then the row
+    await conn.execute(
+        "UPDATE sessions SET deleted_at=now() WHERE session_id=$1 AND user_id=$2 AND deleted_at IS NULL",
+        session_id, user_id
+    )
+
+
+async def clear_session(conn: Connection, session_id: str, user_id: int):
+    # hides every message written so far; lifecycle.py purges them later
+    async with conn.transaction():
+        await conn.execute(
+            """
+            DELETE FROM session_summaries s
+             USING sessions x
+             WHERE s.session_id=x.session_id AND x.session_id=$1 AND x.user_id=$2
+            """,
+            session_id, user_id
+        )
+        await conn.execute(
+            """
+            UPDATE sessions
+               SET cleared_through = (SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM messages_id_seq),
+                   cleared_at = now(),
+                   message_count = 0, last_preview = NULL
+             WHERE session_id=$1 AND user_id=$2 AND deleted_at IS NULL
+            """,
+            session_id, user_id
+        )
+
+
+# === MESSAGES ===
+# A /messages page, live messages only: none for deleted sessions, none up to
+# the last clear, and only partitions from the session's creation on. Every
+# row carries the session's archived_at, and an archived session (messages on
+# disk until lifecycle.rehydrate brings them back) or an empty page is one row
+# with a NULL id; a missing session is no rows.
+MESSAGE_PAGE_SQL = """
+WITH s AS (
+    SELECT cleared_through, created_at, archived_at FROM sessions
+     WHERE session_id=$1 AND user_id=$2 AND deleted_at IS NULL
+)
+SELECT m.id, m.role, m.content, m.created_at, s.archived_at
+  FROM s LEFT JOIN LATERAL (
+    SELECT id,role,content,created_at FROM messages
+     WHERE session_id=$1 AND user_id=$2 AND id > s.cleared_through
+       AND created_at >= s.created_at AND s.archived_at IS NULL
+       AND (created_at, id) {op} ($3, $4)
+     ORDER BY created_at {direction}, id {direction} LIMIT $5
+  ) m ON true
+ ORDER BY m.created_at {direction}, m.id {direction}
+"""
+MESSAGES_AFTER_SQL = MESSAGE_PAGE_SQL.format(op=">", direction="")
+MESSAGES_BEFORE_SQL = MESSAGE_PAGE_SQL.format(op="<", direction="DESC")
+
+
+MEMORIES_SINCE_SQL = """
+SELECT id, content, embedding FROM memories
+ WHERE user_id=$1 AND id > $2 AND embedding_model=$3
+ ORDER BY id
+"""
+
+
+async def memories_since(conn, user_id: int, since: int, embedder_name: str) -> List[Any]:
+    return await conn.fetch(MEMORIES_SINCE_SQL, user_id, since, embedder_name)
+
+
+async def memory_epoch(conn, user_id: int) -> int:
+    return await conn.fetchval(
+        "SELECT epoch FROM memory_consolidation WHERE user_id=$1", user_id,
+    ) or 0
+
+
+# One statement for every memory of a turn (or a batch of jobs). A repeat of
+# an existing memory counts as another mention; the user is registered for
+# consolidation on their first memory.
+STORE_MEMORIES_SQL = """
+WITH stored AS (
+    INSERT INTO memories (user_id, content, embedding, embedding_model)
+    SELECT * FROM unnest($1::int[], $2::text[], $3::bytea[], $4::text[])
+    ON CONFLICT (user_id, content) DO UPDATE
+       SET importance = memories.importance + 1,
+           last_seen  = now()
+    RETURNING user_id
+)
+INSERT INTO memory_consolidation (user_id)
+SELECT DISTINCT user_id FROM stored
+ON CONFLICT DO NOTHING
+"""
+
+
+async def store_memories(conn, rows: List[Tuple[int, str, bytes, str]]):
+    """
+    Insert (user_id, content, embedding, embedding_model) rows.
+    """
+    # ON CONFLICT DO UPDATE can't touch one row twice in a statement
+    unique = list({(r[0], r[1]): r for r in rows}.values())
+    await conn.execute(STORE_MEMORIES_SQL, *map(list, zip(*unique)))
+
+
+# === SEARCH ===
+# Only the newest this-many matches are ranked: a term in most of a user's
+# messages would otherwise mean scoring all of them on every page.
+SEARCH_RANK_WINDOW = int(os.getenv("SEARCH_RANK_WINDOW", 2000))
+
+# `matches` finds and scores the user's matching messages (newest first, so
+# the window comes straight off messages_user_created_idx for common terms and
+# from the GIN index for rare ones) and `page` orders them; content is only
+# read back, and snippets built, for the page, since ts_headline re-parses
+# each document. The tsquery is spelled out at each use rather than computed
+# once in a CTE so the planner can see it and estimate how common the terms
+# are. The content is HTML-escaped before highlighting so the snippet is safe
+# to render with its <mark> tags. Deleted sessions and cleared messages are
+# left out; archived sessions aren't searchable until reopened.
+SEARCH_SQL = """
+WITH matches AS (
+    SELECT m.id, m.created_at, ts_rank(m.search, websearch_to_tsquery('english', $2), 1) AS rank
+      FROM messages m
+      JOIN sessions x ON x.session_id = m.session_id
+     WHERE m.user_id = $1
+       AND m.search @@ websearch_to_tsquery('english', $2)
+       AND x.deleted_at IS NULL
+       AND m.id > x.cleared_through
+       {filters}
+     ORDER BY m.created_at DESC, m.id DESC
+     LIMIT {window}
+),
+page AS (
+    SELECT id, created_at, rank
+      FROM matches
+     {keyset}
+     ORDER BY {order}
+     LIMIT $3
+)
+SELECT p.id, m.session_id, s.title, m.role, p.created_at, p.rank,
+       ts_headline(
+           'english',
+           replace(replace(replace(m.content, '&', '&amp;'), '<', '&lt;'), '>', '&gt;'),
+           websearch_to_tsquery('english', $2),
+           'StartSel=<mark>, StopSel=</mark>, MaxWords=35, MinWords=15'
+       ) AS snippet
+  FROM page p
+  JOIN messages m ON m.id = p.id AND m.created_at = p.created_at
+  JOIN sessions s ON s.session_id = m.session_id
+ ORDER BY {order}
+"""
+
+# order -> (ORDER BY, keyset condition after the previous page's last row)
+SEARCH_ORDERS = {
+    "rank": ("rank DESC, id DESC", "WHERE (rank, id) < (${}::real, ${})"),
+    "recent": ("created_at DESC, id DESC", "AND (m.created_at, m.id) < (${}, ${})"),
+}
+
+
+async def search_messages(
+    conn: Connection,
+    user_id: int,
+    query: str,
+    limit: int,
+    order: str = "rank",
+    after: Optional[Tuple[Any, int]] = None,
+    session_id: Optional[str] = None,
+    role: Optional[str] = None,
+    since: Optional[Any] = None,
+    until: Optional[Any] = None,
+) -> List[Any]:
+    """
+    One page of the user's messages matching `query` (web search syntax:
+    words, "phrases", OR, -word). `after` is the (rank or created_at, id) of
+    the previous page's last row.
+    """
+    order_by, keyset = SEARCH_ORDERS[order]
+    args: List[Any] = [user_id, query, limit]
+    filters = []
+    # only the filters in use go into the statement, so each combination gets
+    # its own prepared plan
+    for clause, value in (
+        ("m.session_id = ${}", session_id),
+        ("m.role = ${}", role),
+        ("m.created_at >= ${}", since),
+        ("m.created_at < ${}", until),
+    ):
+        if value is not None:
+            args.append(value)
+            filters.append("AND " + clause.format(len(args)))
+    keyset_clause = ""
+    if after is not None:
+        args += list(after)
+        keyset_clause = keyset.format(len(args) - 1, len(args))
+        if order == "recent":
+            filters.append(keyset_clause)
+            keyset_clause = ""
+    sql = SEARCH_SQL.format(
+        filters="\n       ".join(filters),
+        # newest first already is the page for recency order
+        window=SEARCH_RANK_WINDOW if order == "rank" else "$3",
+        keyset=keyset_clause,
+        order=order_by,
+    )
+    async with conn.transaction(readonly=True):
+        # the generic plan Postgres switches to after a few runs can't see the
+        # search terms, so rare and common ones get the same (often 10x slower)
+        # plan
+        await conn.execute("SET LOCAL plan_cache_mode = force_custom_plan")
+        return await conn.fetch(sql, *args)
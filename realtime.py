@@ -0,0 +1,264 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+import asyncpg
+from starlette.websockets import WebSocket
+
+import auth
+
+log = logging.getLogger(__name__)
+
+# === CONFIG ===
+# The server pings this often; a client that sends nothing (not even a pong)
+# for WS_IDLE_SECONDS is dropped.
+WS_PING_SECONDS    = float(os.getenv("WS_PING_SECONDS", 20))
+WS_IDLE_SECONDS    = float(os.getenv("WS_IDLE_SECONDS", 60))
+# Frames buffered per connection. Reply streams wait for room (backpressure
+# reaches the upstream stream); pushes that don't fit drop the connection.
+WS_SEND_QUEUE      = int(os.getenv("WS_SEND_QUEUE", 256))
+# Turns one connection may run at once (one per session at most).
+WS_MAX_TURNS       = int(os.getenv("WS_MAX_TURNS", 4))
+# Extra origins allowed to open sockets, comma separated; the page's own
+# origin always is.
+WS_ALLOWED_ORIGINS = {o.strip() for o in os.getenv("WS_ALLOWED_ORIGINS", "").split(",") if o.strip()}
+
+# pg_notify channel fed by the sessions trigger (migration 10)
+CHANNEL = "session_events"
+# queued by Connection.close(): the writer closes the socket when it gets here
+_CLOSE: Dict[str, Any] = {"type": "close"}
+
+Handler = Callable[["Connection", Dict[str, Any]], Awaitable[None]]
+
+
+def origin_allowed(websocket: WebSocket) -> bool:
+    """
+    Cookies ride along on cross-site socket handshakes, so only accept the
+    page's own origin (or a configured one). Non-browser clients send none.
+    """
+    origin = websocket.headers.get("origin")
+    if origin is None or origin in WS_ALLOWED_ORIGINS:
+        return True
+    return urlsplit(origin).netloc == websocket.headers.get("host")
+
+
+class Connection:
+    """
+    One client socket: a reader dispatching JSON frames to a handler, a
+    writer draining a bounded queue (consecutive deltas of one reply are
+    merged into a single frame when the client falls behind) and a heartbeat.
+    """
+
+    def __init__(self, websocket: WebSocket, user: Dict[str, Any], claims: Dict[str, Any]):
+        self.websocket = websocket
+        self.user = user
+        self.claims = claims
+        self.queue: asyncio.Queue = asyncio.Queue(WS_SEND_QUEUE)
+        self.turns: Dict[Hashable, asyncio.Task] = {}
+        self.cancelled: Set[Hashable] = set()
+        self.last_seen = time.monotonic()
+        self._closing: Optional[Tuple[int, str]] = None
+
+    # === SENDING ===
+    async def send(self, frame: Dict[str, Any]):
+        """
+        Queue a frame, waiting while the client is behind.
+        """
+        if self._closing is None:
+            await self.queue.put(frame)
+
+    def push(self, frame: Dict[str, Any]):
+        """
+        Queue an unsolicited frame without waiting; a client too far behind
+        to take it is disconnected (it resyncs on reconnect).
+        """
+        if self._closing is not None:
+            return
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            self.close(1013, "Client too slow")
+
+    def close(self, code: int = 1000, reason: str = ""):
+        """
+        Close after the frames already queued have been sent.
+        """
+        if self._closing is not None:
+            return
+        self._closing = (code, reason)
+        if self.queue.full():
+            # it isn't reading them anyway
+            while not self.queue.empty():
+                self.queue.get_nowait()
+        self.queue.put_nowait(_CLOSE)
+
+    async def _writer(self):
+        pending = None
+        while True:
+            frame = pending or await self.queue.get()
+            pending = None
+            if frame is _CLOSE:
+                await self.websocket.close(*self._closing)
+                return
+            if frame["type"] == "delta":
+                while not self.queue.empty():
+                    following = self.queue.get_nowait()
+                    if following is not _CLOSE and following["type"] == "delta" and following["id"] == frame["id"]:
+                        frame["content"] += following["content"]
+                    else:
+                        pending = following
+                        break
+            await self.websocket.send_text(json.dumps(frame))
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(WS_PING_SECONDS)
+            if time.monotonic() - self.last_seen > WS_IDLE_SECONDS:
+                self.close(1001, "Idle")
+                return
+            # the socket outlives its access token, but not a logout
+            if auth.revoked(self.claims):
+                self.close(4401, "Logged out")
+                return
+            self.push({"type": "ping"})
+
+    # === TURNS ===
+    def start(self, request_id: Hashable, coro: Awaitable[None]) -> bool:
+        if request_id in self.turns or len(self.turns) >= WS_MAX_TURNS:
+            coro.close()
+            return False
+        task = asyncio.create_task(coro)
+        self.turns[request_id] = task
+        task.add_done_callback(lambda _: self._forget(request_id))
+        return True
+
+    def _forget(self, request_id: Hashable):
+        self.turns.pop(request_id, None)
+        self.cancelled.discard(request_id)
+
+    def cancel(self, request_id: Hashable) -> bool:
+        task = self.turns.get(request_id)
+        if task is None:
+            return False
+        self.cancelled.add(request_id)
+        task.cancel()
+        return True
+
+    # === LIFECYCLE ===
+    async def serve(self, handle: Handler):
+        hub.add(self)
+        writer = asyncio.create_task(self._writer())
+        heartbeat = asyncio.create_task(self._heartbeat())
+        receiver = asyncio.create_task(self._receive(handle))
+        try:
+            # the writer ends when we close; the receiver when the client does
+            await asyncio.wait({writer, receiver}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            hub.remove(self)
+            for task in (receiver, heartbeat, writer, *self.turns.values()):
+                task.cancel()
+            await asyncio.gather(receiver, heartbeat, writer, return_exceptions=True)
+
+    async def _receive(self, handle: Handler):
+        while True:
+            message = await self.websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            self.last_seen = time.monotonic()
+            try:
+                frame = json.loads(message.get("text") or "")
+                if not isinstance(frame, dict) or not isinstance(frame.get("type"), str):
+                    raise ValueError
+            except ValueError:
+                self.push({"type": "error", "status": 400, "detail": "Expected a JSON object with a type"})
+                continue
+            await handle(self, frame)
+
+
+class Hub:
+    """
+    This process's open sockets by user, and the LISTEN connection that
+    relays session changes from every worker (via the sessions trigger) to
+    them. The listener takes one connection per process, outside the pool.
+    """
+
+    def __init__(self):
+        self.connections: Dict[int, Set[Connection]] = {}
+        self.counters = {"notifications": 0, "reconnects": 0}
+        self._task: Optional[asyncio.Task] = None
+        self._listening = False
+
+    def add(self, connection: Connection):
+        self.connections.setdefault(connection.user["id"], set()).add(connection)
+
+    def remove(self, connection: Connection):
+        group = self.connections.get(connection.user["id"])
+        if group is not None:
+            group.discard(connection)
+            if not group:
+                del self.connections[connection.user["id"]]
+
+    def deliver(self, user_id: int, frame: Dict[str, Any]):
+        for connection in list(self.connections.get(user_id, ())):
+            connection.push(dict(frame))
+
+    def start(self, dsn: str):
+        self._task = asyncio.create_task(self._listen(dsn))
+
+    async def stop(self):
+        for group in list(self.connections.values()):
+            for connection in list(group):
+                connection.close(1012, "Server restarting")
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _listen(self, dsn: str):
+        attempt = 0
+        while True:
+            lost = asyncio.Event()
+            conn = None
+            try:
+                conn = await asyncpg.connect(dsn)
+                conn.add_termination_listener(lambda _: lost.set())
+                await conn.add_listener(CHANNEL, self._on_notify)
+                self._listening = True
+                if attempt:
+                    # changes made while we weren't listening are lost
+                    self.counters["reconnects"] += 1
+                    for user_id in list(self.connections):
+                        self.deliver(user_id, {"type": "resync"})
+                attempt = 0
+                await lost.wait()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.warning("session event listener failed", exc_info=True)
+            finally:
+                self._listening = False
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            attempt += 1
+            await asyncio.sleep(min(30.0, 0.5 * 2 ** attempt))
+
+    def _on_notify(self, conn, pid, channel, payload: str):
+        self.counters["notifications"] += 1
+        event = json.loads(payload)
+        self.deliver(event.pop("user_id"), {"type": "session", **event})
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "connections": sum(len(group) for group in self.connections.values()),
+            "users": len(self.connections),
+            "listening": int(self._listening),
+            "turns": sum(len(c.turns) for group in self.connections.values() for c in group),
+        }
+
+
+hub = Hub()
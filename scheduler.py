@@ -0,0 +1,299 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional
+
+import openai
+from fastapi import HTTPException
+
+import shared
+
+log = logging.getLogger(__name__)
+
+# === CONFIG ===
+# Upstream account limits; 0 disables a bucket.
+OPENAI_RPM              = int(os.getenv("OPENAI_RPM", 500))
+OPENAI_TPM              = int(os.getenv("OPENAI_TPM", 200000))
+# Upstream calls allowed in flight at once (a stream holds its slot until it ends).
+OPENAI_MAX_CONCURRENCY  = int(os.getenv("OPENAI_MAX_CONCURRENCY", 32))
+# Worker processes sharing the limits above (set by serve.py / gunicorn);
+# each process enforces an equal share.
+WEB_CONCURRENCY         = max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+# Reply tokens reserved per call before the real usage is known.
+SCHEDULER_REPLY_TOKENS  = int(os.getenv("SCHEDULER_REPLY_TOKENS", 500))
+# Calls allowed to wait for admission before new ones are refused with a 503.
+SCHEDULER_QUEUE_LIMIT   = int(os.getenv("SCHEDULER_QUEUE_LIMIT", 256))
+# Longest a call waits for admission before giving up with a 503.
+SCHEDULER_MAX_WAIT      = float(os.getenv("SCHEDULER_MAX_WAIT", 30))
+SCHEDULER_MAX_RETRIES   = int(os.getenv("SCHEDULER_MAX_RETRIES", 3))
+# A turn lock older than this is assumed abandoned (e.g. a dropped stream).
+SCHEDULER_TURN_TIMEOUT  = float(os.getenv("SCHEDULER_TURN_TIMEOUT", 300))
+
+RETRYABLE = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+
+class UpstreamError(HTTPException):
+    """
+    The upstream kept failing through every retry (as opposed to this
+    process refusing to queue more work).
+    """
+
+
+def backoff(attempt: int, retry_after: Optional[float] = None) -> float:
+    if retry_after is not None:
+        return retry_after + random.uniform(0, 0.25)
+    return min(20.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Continuously refilled bucket holding up to one minute's allowance.
+    The level may go negative when real usage exceeds what was reserved.
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self._stamp = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def delay(self, amount: float) -> float:
+        """
+        Seconds until `amount` can be taken (0 if it can be taken now).
+        """
+        if self.capacity <= 0:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        if self.capacity > 0:
+            self.level -= amount
+
+    def give(self, amount: float):
+        if self.capacity > 0:
+            self._refill()
+            self.level = min(self.capacity, self.level + amount)
+
+
+class _Waiter:
+    __slots__ = ("future", "tokens", "queued_at")
+
+    def __init__(self, future: asyncio.Future, tokens: int):
+        self.future = future
+        self.tokens = tokens
+        self.queued_at = time.monotonic()
+
+
+class Scheduler:
+    """
+    Admission control for upstream LLM calls.
+
+    Calls wait in per-user FIFO queues and are admitted round-robin across
+    users whenever the request and token buckets and the concurrency limit
+    allow, so one busy user can't starve the rest. A 429 pauses admission
+    for everyone (the quota is shared); 429s, 5xx and connection errors are
+    retried with jittered backoff. Separately, each (user, session) may have
+    only one turn in progress.
+    """
+
+    def __init__(
+        self,
+        rpm: int = OPENAI_RPM,
+        tpm: int = OPENAI_TPM,
+        max_concurrency: int = OPENAI_MAX_CONCURRENCY,
+        state=None,
+    ):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.inflight = 0
+        self._waiting: "OrderedDict[Hashable, Deque[_Waiter]]" = OrderedDict()
+        self._depth = 0
+        self._paused_until = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # turn locks live in shared state so they hold across workers
+        self.state = state or shared.state
+        self._turns = 0
+        self._waits: Deque[float] = deque(maxlen=1000)
+        self.counters = {
+            "admitted": 0, "rejected": 0, "timeouts": 0, "retries": 0,
+            "rate_limited": 0, "failed": 0, "turn_conflicts": 0,
+        }
+
+    # === TURNS ===
+    async def begin_turn(self, user_id: int, session_id: str):
+        """
+        Claim the session for one turn; 409 if a turn is already running.
+        """
+        if not await self.state.add(f"turn:{user_id}:{session_id}", "1", SCHEDULER_TURN_TIMEOUT):
+            self.counters["turn_conflicts"] += 1
+            raise HTTPException(409, "A reply is already in progress for this session")
+        self._turns += 1
+
+    async def end_turn(self, user_id: int, session_id: str):
+        self._turns -= 1
+        await self.state.delete(f"turn:{user_id}:{session_id}")
+
+    @property
+    def active_turns(self) -> int:
+        """
+        Turns running in this process.
+        """
+        return self._turns
+
+    # === ADMISSION ===
+    async def acquire(self, user_id: Hashable, tokens: int):
+        """
+        Wait for this user's turn and for capacity, then hold a slot until
+        release().
+        """
+        if self._depth >= SCHEDULER_QUEUE_LIMIT:
+            self.counters["rejected"] += 1
+            raise HTTPException(503, "Server busy, try again shortly", headers={"Retry-After": "1"})
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), tokens)
+        self._waiting.setdefault(user_id, deque()).append(waiter)
+        self._depth += 1
+        self._pump()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), SCHEDULER_MAX_WAIT)
+        except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release()  # admitted just as we gave up
+            else:
+                waiter.future.cancel()
+                self._forget(user_id, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.counters["timeouts"] += 1
+                raise HTTPException(503, "Server busy, try again shortly", headers={"Retry-After": "5"})
+            raise
+
+    def release(self, reserved: int = 0, used: Optional[int] = None):
+        """
+        Free a slot; with `used`, settle the token reservation against real usage.
+        """
+        self.inflight -= 1
+        if used is not None:
+            self.tokens.give(reserved - used)
+        self._pump()
+
+    def _forget(self, user_id: Hashable, waiter: _Waiter):
+        queue = self._waiting.get(user_id)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self._depth -= 1
+            if not queue:
+                del self._waiting[user_id]
+        self._pump()
+
+    def _pump(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiting and self.inflight < self.max_concurrency:
+            user_id, queue = next(iter(self._waiting.items()))
+            waiter = queue[0]
+            delay = max(
+                self._paused_until - time.monotonic(),
+                self.requests.delay(1),
+                self.tokens.delay(waiter.tokens),
+            )
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._pump)
+                return
+            queue.popleft()
+            self._depth -= 1
+            # round robin: this user goes to the back of the line
+            del self._waiting[user_id]
+            if queue:
+                self._waiting[user_id] = queue
+            self.requests.take(1)
+            self.tokens.take(waiter.tokens)
+            self.inflight += 1
+            self.counters["admitted"] += 1
+            self._waits.append(time.monotonic() - waiter.queued_at)
+            waiter.future.set_result(None)
+
+    # === CALLS ===
+    async def open(self, user_id: Hashable, tokens: int, call: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run `call` once admitted, retrying transient upstream errors. The slot
+        stays held on success; the caller must release() it (for streams,
+        when the stream ends).
+        """
+        attempt = 0
+        while True:
+            await self.acquire(user_id, tokens)
+            try:
+                return await call()
+            except RETRYABLE as e:
+                self.release()
+                retry_after = _retry_after(e)
+                if isinstance(e, openai.RateLimitError):
+                    self.counters["rate_limited"] += 1
+                    # the quota is shared, so everyone waits
+                    self._paused_until = max(
+                        self._paused_until, time.monotonic() + backoff(attempt, retry_after)
+                    )
+                attempt += 1
+                if attempt > SCHEDULER_MAX_RETRIES:
+                    self.counters["failed"] += 1
+                    log.warning("upstream call failed after %d attempts: %s", attempt, e)
+                    if isinstance(e, openai.RateLimitError):
+                        raise UpstreamError(503, "Upstream is rate limiting, try again shortly",
+                                            headers={"Retry-After": str(int(retry_after or 5))}) from e
+                    raise UpstreamError(502, "Upstream error") from e
+                self.counters["retries"] += 1
+                await asyncio.sleep(backoff(attempt, retry_after))
+            except BaseException:
+                self.release()
+                raise
+
+    async def call(self, user_id: Hashable, tokens: int, call: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        open() and release in one go, settling tokens against the response's usage.
+        """
+        response = await self.open(user_id, tokens, call)
+        usage = getattr(response, "usage", None)
+        self.release(tokens, getattr(usage, "total_tokens", None))
+        return response
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._waits)
+        return {
+            **self.counters,
+            "queued": self._depth,
+            "queued_users": len(self._waiting),
+            "inflight": self.inflight,
+            "active_turns": self._turns,
+            "requests_available": round(self.requests.level, 1),
+            "tokens_available": round(self.tokens.level, 1),
+            "paused_seconds": round(max(0.0, self._paused_until - time.monotonic()), 3),
+            "wait_ms_p50": round(waits[len(waits) // 2] * 1000, 1) if waits else 0.0,
+            "wait_ms_p95": round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+            "wait_ms_max": round(waits[-1] * 1000, 1) if waits else 0.0,
+        }
+
+
+def _share(limit: int) -> int:
+    return max(1, limit // WEB_CONCURRENCY) if limit > 0 else limit
+
+
+scheduler = Scheduler(_share(OPENAI_RPM), _share(OPENAI_TPM), _share(OPENAI_MAX_CONCURRENCY))
@@ -0,0 +1,116 @@
+import os
+import time
+from typing import Any, Dict, Optional, Tuple
+
+# === CONFIG ===
+# State that must agree across worker processes (cache tier, turn locks,
+# revocation notices). Unset means an in-process stand-in, which is only
+# correct with a single worker. redis://... needs the `redis` package.
+SHARED_STATE_URL = os.getenv("SHARED_STATE_URL") or os.getenv("CACHE_REDIS_URL")
+
+
+class LocalState:
+    """
+    In-process stand-in: a dict with per-key expiry.
+    """
+
+    shared = False
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[Optional[float], Any]] = {}
+        self._writes = 0
+
+    def _live(self, key: str) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires is not None and expires < time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    def _put(self, key: str, value: Any, ttl: Optional[float]):
+        self._data[key] = (time.monotonic() + ttl if ttl else None, value)
+        self._writes += 1
+        if self._writes % 1024 == 0:
+            for k in list(self._data):
+                self._live(k)
+
+    async def get(self, key: str) -> Optional[str]:
+        value = self._live(key)
+        return None if value is None else str(value)
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        self._put(key, value, ttl)
+
+    async def add(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        """
+        Set `key` only if it is absent. Returns whether it was set.
+        """
+        if self._live(key) is not None:
+            return False
+        self._put(key, value, ttl)
+        return True
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """
+        Add to a counter, creating it (with `ttl`) if absent.
+        """
+        current = self._live(key)
+        if current is None:
+            self._put(key, amount, ttl)
+            return amount
+        expires, value = self._data[key]
+        self._data[key] = (expires, value + amount)
+        return value + amount
+
+    async def delete(self, key: str):
+        self._data.pop(key, None)
+
+    async def close(self):
+        pass
+
+
+class RedisState:
+    """
+    Shared across processes and hosts. Needs the `redis` package (redis.asyncio).
+    """
+
+    shared = True
+
+    def __init__(self, url: str, prefix: str = "77ai:"):
+        import redis.asyncio as redis
+        self.client = redis.from_url(url)
+        self.prefix = prefix
+
+    async def get(self, key: str) -> Optional[str]:
+        value = await self.client.get(self.prefix + key)
+        return value.decode("utf-8") if value is not None else None
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        await self.client.set(self.prefix + key, value, px=int(ttl * 1000) if ttl else None)
+
+    async def add(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        return bool(await self.client.set(
+            self.prefix + key, value, nx=True, px=int(ttl * 1000) if ttl else None,
+        ))
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        value = await self.client.incrby(self.prefix + key, amount)
+        if ttl and value == amount:
+            await self.client.pexpire(self.prefix + key, int(ttl * 1000))
+        return value
+
+    async def delete(self, key: str):
+        await self.client.delete(self.prefix + key)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def connect(url: Optional[str] = SHARED_STATE_URL):
+    return RedisState(url) if url else LocalState()
+
+
+state = connect()
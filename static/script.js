@@ -1,5 +1,20 @@
 document.addEventListener("DOMContentLoaded", init);
 let currentSession = null;
+// Per-session message cache: {messages, before, after, hasOlder}
+const sessionCache = {};
+let loadingOlder = false;
+let refreshing = null;
+let loggedIn = false;
+let sessionsCursor = null;
+
+// fetch() that renews the short-lived access token once on a 401
+async function api(url, opts) {
+  let res = await fetch(url, opts);
+  if (res.status !== 401) return res;
+  refreshing = refreshing || fetch("/refresh", {method:"POST"}).finally(()=>{ refreshing = null; });
+  if (!(await refreshing).ok) return res;
+  return fetch(url, opts);
+}
 
 async function init() {
   // Auth tabs
@@ -11,11 +26,15 @@ async function init() {
   document.getElementById("logout-btn").onclick   = logout;
   // Session/chat actions
   document.getElementById("new-chat").onclick       = createNewSession;
-  document.getElementById("session-select").onchange = e=>loadMessages(e.target.value);
+  document.getElementById("session-select").onchange = e=>e.target.value ? loadMessages(e.target.value) : loadMoreSessions();
   document.getElementById("rename-btn").onclick     = renameSession;
   document.getElementById("delete-btn").onclick     = deleteCurrentSession;
   document.getElementById("clear-btn").onclick      = ()=>clearChat(currentSession);
   document.getElementById("send-btn").onclick       = sendPrompt;
+  document.getElementById("stop-btn").onclick       = stopReply;
+  el("chat-box").addEventListener("scroll", ()=>{
+    if (el("chat-box").scrollTop < 50) loadOlder();
+  });
 
   // Placeholder + Enter to send
   const input = document.getElementById("prompt");
@@ -43,12 +62,13 @@ function toggleTab(tab) {
 }
 
 async function fetchMe() {
-  const ok = (await fetch("/me")).ok;
+  const ok = loggedIn = (await api("/me")).ok;
   const authEls = ["auth-container"];
   const appEls  = ["new-chat","session-select","rename-btn","delete-btn","clear-btn","logout-btn","app-container"];
   if (ok) {
     authEls.forEach(id=>el(id).style.display="none");
     appEls.forEach(id=>el(id).style.display = id==="app-container" ? "flex" : "inline-block");
+    connectSocket();
     await loadSessions();
   } else {
     authEls.forEach(id=>el(id).style.display="flex");
@@ -77,29 +97,67 @@ async function signup() {
 }
 
 async function logout() {
+  loggedIn = false;
+  if (socket) socket.close(1000);
   await fetch("/logout",{method:"POST"});
   currentSession = null;
+  Object.keys(sessionCache).forEach(k=>delete sessionCache[k]);
   el("session-select").innerHTML = "";
   el("chat-box").innerHTML       = "";
   await fetchMe();
 }
 
+// A page of sessions, most recently active first: {sessions, has_more, cursor}
+async function fetchSessions(cursor) {
+  if (socketOpen()) {
+    try { return await rpc({type:"sessions", cursor}); } catch (e) {}
+  }
+  return api(cursor ? `/sessions?cursor=${encodeURIComponent(cursor)}` : "/sessions").then(r=>r.json());
+}
+
+function renderSessions(page, append) {
+  const sel = el("session-select");
+  if (!append) sel.innerHTML = "";
+  const more = sel.querySelector("option[data-more]");
+  if (more) more.remove();
+  page.sessions.forEach(s=>sel.appendChild(sessionOption(s)));
+  sessionsCursor = page.cursor;
+  if (page.has_more) {
+    const opt = document.createElement("option");
+    opt.value = "";
+    opt.dataset.more = "1";
+    opt.textContent = "More…";
+    sel.appendChild(opt);
+  }
+  sel.style.display = sel.options.length ? "inline-block" : "none";
+  if (currentSession) sel.value = currentSession;
+}
+
+async function loadMoreSessions() {
+  renderSessions(await fetchSessions(sessionsCursor), true);
+}
+
+function sessionOption(s) {
+  const opt = document.createElement("option");
+  opt.value = s.id;
+  opt.textContent = s.title || "New Chat";
+  // hover text: the last message and how long the session is
+  if (s.message_count) opt.title = `${s.preview || ""}\n(${s.message_count} messages)`;
+  return opt;
+}
+
 async function loadSessions() {
-  const sessions = await fetch("/sessions").then(r=>r.json());
-  const sel      = el("session-select");
-  sel.innerHTML  = sessions.map(s=>
-    `<option value="${s.id}">${s.title || "New Chat"}</option>`
-  ).join("");
-  sel.style.display = sessions.length ? "inline-block" : "none";
-  if (sessions.length) {
-    await loadMessages(sessions[0].id);
+  const page = await fetchSessions();
+  renderSessions(page);
+  if (page.sessions.length) {
+    await loadMessages(page.sessions[0].id);
   } else {
     await createNewSession();
   }
 }
 
 async function createNewSession() {
-  const {id} = await fetch("/sessions", {
+  const {id} = await api("/sessions", {
     method:"POST", headers:{"Content-Type":"application/json"},
     body: JSON.stringify({title:null})
   }).then(r=>r.json());
@@ -110,60 +168,257 @@ async function createNewSession() {
 async function renameSession() {
   const title = prompt("New name:");
   if (!title) return;
-  await fetch(`/sessions/${currentSession}`, {
+  await api(`/sessions/${currentSession}`, {
     method:"PATCH",             // ← use PATCH
     headers:{"Content-Type":"application/json"},
     body: JSON.stringify({title})
   });
+  // the socket pushes the new title
+  if (socketOpen()) return;
   await loadSessions();
   selectOption(currentSession); // ← re-select to show new label
 }
 
 async function deleteCurrentSession() {
   if (!confirm("Really delete this chat?")) return;
-  await fetch(`/sessions/${currentSession}`, {method:"DELETE"});
+  await api(`/sessions/${currentSession}`, {method:"DELETE"});
+  delete sessionCache[currentSession];
   currentSession = null;
   await loadSessions();
 }
 
+async function fetchMessages(sessionId, params) {
+  if (socketOpen()) {
+    try {
+      return await rpc({type:"messages", session_id:sessionId,
+                        before:params.before, after:params.since || params.after});
+    } catch (e) {}
+  }
+  const q = new URLSearchParams({session_id:sessionId, ...params});
+  return api(`/messages?${q}`).then(r=>r.json());
+}
+
+function messageLine(m) {
+  const d = document.createElement("div");
+  d.className = m.role;
+  d.textContent = `${m.role==="user"?"You":"AI"}: ${m.content}`;
+  return d;
+}
+
 async function loadMessages(sessionId) {
   currentSession = sessionId;
-  const msgs = await fetch(`/messages?session_id=${sessionId}`).then(r=>r.json());
+  let cache = sessionCache[sessionId];
+  if (cache && cache.after) {
+    // only fetch what arrived since we last looked
+    const page = await fetchMessages(sessionId, {since:cache.after});
+    cache.messages.push(...page.messages);
+    cache.after = page.after || cache.after;
+  } else {
+    const page = await fetchMessages(sessionId, {});
+    cache = sessionCache[sessionId] = {
+      messages: page.messages, before: page.before,
+      after: page.after, hasOlder: page.has_more,
+    };
+  }
+  if (sessionId !== currentSession) return;
   const box  = el("chat-box");
   box.innerHTML = "";
   showSystemMessage("Your mirror awaits—let's begin.");
-  msgs.forEach(m=>{
-    const d = document.createElement("div");
-    d.className = m.role;
-    d.textContent = `${m.role==="user"?"You":"AI"}: ${m.content}`;
-    box.appendChild(d);
-  });
+  const frag = document.createDocumentFragment();
+  cache.messages.forEach(m=>frag.appendChild(messageLine(m)));
+  box.appendChild(frag);
   box.scrollTop = box.scrollHeight;
   ["rename-btn","delete-btn","clear-btn"].forEach(id=>el(id).style.display="inline-block");
 }
 
+async function loadOlder() {
+  const sessionId = currentSession;
+  const cache = sessionCache[sessionId];
+  if (!cache || !cache.hasOlder || loadingOlder) return;
+  loadingOlder = true;
+  try {
+    const page = await fetchMessages(sessionId, {before:cache.before});
+    cache.messages.unshift(...page.messages);
+    cache.before   = page.before;
+    cache.hasOlder = page.has_more;
+    if (sessionId !== currentSession) return;
+    const box = el("chat-box");
+    const height = box.scrollHeight;
+    const frag = document.createDocumentFragment();
+    page.messages.forEach(m=>frag.appendChild(messageLine(m)));
+    // keep the greeting line on top
+    box.insertBefore(frag, box.firstChild.nextSibling);
+    box.scrollTop += box.scrollHeight - height;
+  } finally {
+    loadingOlder = false;
+  }
+}
+
 async function clearChat(sessionId) {
-  await fetch(`/sessions/${sessionId}/messages`, {method:"DELETE"});
+  await api(`/sessions/${sessionId}/messages`, {method:"DELETE"});
+  delete sessionCache[sessionId];
   el("chat-box").innerHTML = "";
   showSystemMessage("Chat cleared—speak again.");
 }
 
+let sending = false;
+
 async function sendPrompt() {
   const txt = el("prompt").value.trim();
-  if (!txt || !currentSession) return;
-  const box = el("chat-box");
-  appendLine(box, "user", `You: ${txt}`);
-  el("prompt").value = "";
-  box.scrollTop = box.scrollHeight;
+  if (!txt || !currentSession || sending) return;
+  sending = true;
+  el("send-btn").disabled = true;
+  try {
+    const box = el("chat-box");
+    appendLine(box, "user", `You: ${txt}`);
+    el("prompt").value = "";
+    box.scrollTop = box.scrollHeight;
 
-  const res = await fetch("/reflect", {
-    method:"POST", headers:{"Content-Type":"application/json"},
-    body: JSON.stringify({session_id:currentSession,prompt:txt})
+    if (socketOpen()) return await replyOverSocket(box, txt);
+    const res = await api("/reflect/stream", {
+      method:"POST", headers:{"Content-Type":"application/json"},
+      body: JSON.stringify({session_id:currentSession,prompt:txt})
+    });
+    if (res.status === 409) return showSystemMessage("Still replying to your last message.");
+    if (!res.ok) return showSystemMessage("Error sending message.");
+    const line = appendLine(box, "ai", "AI: ");
+    await readEvents(res, (event, data)=>{
+      if (event === "delta") {
+        line.textContent += data.content;
+        box.scrollTop = box.scrollHeight;
+      } else if (event === "error") {
+        showSystemMessage(data.status === 503 ? "Busy right now, try again shortly." : "Error sending message.");
+      }
+    });
+  } finally {
+    sending = false;
+    el("send-btn").disabled = false;
+  }
+}
+
+async function replyOverSocket(box, txt) {
+  const line = appendLine(box, "ai", "AI: ");
+  const id = currentReply = nextRequestId++;
+  el("stop-btn").style.display = "inline-block";
+  try {
+    await rpc({type:"reflect", id, session_id:currentSession, prompt:txt}, f=>{
+      if (f.type === "delta") {
+        line.textContent += f.content;
+        box.scrollTop = box.scrollHeight;
+      }
+    });
+  } catch (err) {
+    if (line.textContent === "AI: ") line.remove();
+    if (err.status === 409) showSystemMessage("Still replying to your last message.");
+    else showSystemMessage(err.status === 503 ? "Busy right now, try again shortly." : "Error sending message.");
+  } finally {
+    currentReply = null;
+    el("stop-btn").style.display = "none";
+  }
+}
+
+function stopReply() {
+  // what was said so far is kept
+  if (currentReply && socketOpen()) socket.send(JSON.stringify({type:"cancel", id:currentReply}));
+}
+
+// === SOCKET ===
+// One WebSocket carries sessions, messages and replies once logged in, and
+// pushes session list changes; the fetch() paths cover the gaps while it
+// (re)connects.
+let socket = null;
+let socketRetries = 0;
+let nextRequestId = 1;
+let currentReply = null;
+const requests = {};  // request id -> {resolve, reject, onEvent}
+
+function connectSocket() {
+  if (socket) return;
+  const ws = socket = new WebSocket(`${location.protocol === "https:" ? "wss" : "ws"}://${location.host}/ws`);
+  ws.onopen = ()=>{ socketRetries = 0; };
+  ws.onmessage = e=>onFrame(JSON.parse(e.data));
+  ws.onclose = async e=>{
+    socket = null;
+    Object.keys(requests).forEach(id=>{
+      requests[id].reject({status:0, detail:"Connection lost"});
+      delete requests[id];
+    });
+    if (!loggedIn || e.code === 1000) return;
+    if (e.code === 4401) {
+      // expired access token (renew it) or logged out elsewhere
+      const res = await fetch("/refresh", {method:"POST"});
+      if (!res.ok) return fetchMe();
+    }
+    setTimeout(connectSocket, Math.min(30000, 500 * 2 ** socketRetries++));
+  };
+}
+
+function socketOpen() {
+  return socket && socket.readyState === WebSocket.OPEN;
+}
+
+// Send a request frame; resolves with its reply, rejects with an error frame
+function rpc(frame, onEvent) {
+  const id = frame.id || nextRequestId++;
+  return new Promise((resolve, reject)=>{
+    requests[id] = {resolve, reject, onEvent};
+    socket.send(JSON.stringify({...frame, id}));
   });
-  if (!res.ok) return showSystemMessage("Error sending message.");
-  const {messages} = await res.json();
-  messages.forEach(m=>appendLine(box, "ai", `AI: ${m.content}`));
-  box.scrollTop = box.scrollHeight;
+}
+
+function onFrame(f) {
+  const req = f.id != null ? requests[f.id] : null;
+  if (req) {
+    if (f.type === "meta" || f.type === "delta") return req.onEvent && req.onEvent(f);
+    delete requests[f.id];
+    return f.type === "error" ? req.reject(f) : req.resolve(f);
+  }
+  if (f.type === "ping") socket.send(JSON.stringify({type:"pong"}));
+  else if (f.type === "session") applySessionChange(f.op, f.session);
+  else if (f.type === "resync") fetchSessions().then(page=>renderSessions(page));
+}
+
+// Another tab, or the server, changed the session list
+function applySessionChange(op, s) {
+  const sel = el("session-select");
+  const opt = [...sel.options].find(o=>o.value === s.id);
+  if (op === "deleted") {
+    if (opt) opt.remove();
+    delete sessionCache[s.id];
+    if (s.id === currentSession) {
+      currentSession = null;
+      loadSessions();
+    }
+  } else if (opt) {
+    opt.textContent = s.title || "New Chat";
+  } else {
+    sel.prepend(sessionOption(s));
+    sel.style.display = "inline-block";
+    if (currentSession) sel.value = currentSession;
+  }
+}
+
+// Parse a text/event-stream response body, calling onEvent(event, data)
+async function readEvents(res, onEvent) {
+  const reader  = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buf = "";
+  for (;;) {
+    const {value, done} = await reader.read();
+    if (done) break;
+    buf += decoder.decode(value, {stream:true});
+    let i;
+    while ((i = buf.indexOf("\n\n")) >= 0) {
+      const block = buf.slice(0, i);
+      buf = buf.slice(i + 2);
+      let event = "message", data = "";
+      block.split("\n").forEach(l=>{
+        if (l.startsWith("event: ")) event = l.slice(7);
+        else if (l.startsWith("data: ")) data += l.slice(6);
+      });
+      onEvent(event, data ? JSON.parse(data) : {});
+    }
+  }
 }
 
 function showSystemMessage(text) {
@@ -175,6 +430,7 @@ function appendLine(container, cls, text) {
   d.className = cls;
   d.textContent = text;
   container.appendChild(d);
+  return d;
 }
 
 function el(id){return document.getElementById(id)}
@@ -0,0 +1,58 @@
+import os
+import re
+from typing import Optional
+
+# === CONFIG ===
+SESSION_TITLE_MAX_WORDS = int(os.getenv("SESSION_TITLE_MAX_WORDS", 6))
+SESSION_TITLE_MAX_CHARS = int(os.getenv("SESSION_TITLE_MAX_CHARS", 60))
+
+# greetings and throat-clearing before the actual subject
+_FILLER = re.compile(
+    r"^(?:(?:hi|hello|hey|ok(?:ay)?|so|well|um+|uh+|yeah|yes|no|please|thanks|thank you)\b[\s,.!-]*)+",
+    re.IGNORECASE,
+)
+# "I want to talk about X" -> "X"
+_LEAD_IN = re.compile(
+    r"^(?:i(?:'d| would)? (?:just )?(?:want|need|like|wanted|would like) to (?:talk|chat|think|reflect|vent)"
+    r" (?:about|on|through) |can we (?:talk|chat) about |let'?s talk about |i'?ve been thinking (?:about|of) "
+    r"|i'?m thinking about |tell me about )",
+    re.IGNORECASE,
+)
+_SENTENCE = re.compile(r"[.!?\n]+")
+_WORD = re.compile(r"[\w'’-]+")
+# not worth ending a title on, nor enough to make one
+_STOPWORDS = {
+    "a", "an", "the", "and", "or", "but", "so", "to", "of", "in", "on", "at", "for", "with", "about",
+    "from", "by", "as", "is", "am", "are", "was", "were", "be", "been", "it", "its", "this", "that",
+    "my", "me", "i", "i'm", "you", "your", "we", "our", "because", "when", "if", "than", "then",
+    "just", "really", "very", "do", "did", "have", "has", "had", "not", "what", "how", "why",
+}
+
+
+def heuristic_title(prompt: str) -> Optional[str]:
+    """
+    A short title from the opening of the first prompt, or None when it has
+    too little to go on ("hi", a lone question word...).
+    """
+    for sentence in _SENTENCE.split(prompt):
+        sentence = _LEAD_IN.sub("", _FILLER.sub("", sentence.strip()))
+        words = _WORD.findall(sentence)[:SESSION_TITLE_MAX_WORDS]
+        while words and words[-1].lower() in _STOPWORDS:
+            words.pop()
+        if len(words) >= 2 and any(w.lower() not in _STOPWORDS for w in words):
+            title = " ".join(words)
+            if len(title) > SESSION_TITLE_MAX_CHARS:
+                title = title[:SESSION_TITLE_MAX_CHARS].rsplit(" ", 1)[0]
+            return title[0].upper() + title[1:]
+    return None
+
+
+def clean_title(text: str) -> Optional[str]:
+    """
+    Tidy a model-written title: one line, no quotes or trailing period.
+    """
+    lines = text.strip().splitlines()
+    title = lines[0].strip().strip("\"'“”*#").strip().rstrip(".") if lines else ""
+    if title.lower().startswith("title:"):
+        title = title[6:].strip()
+    return title[:SESSION_TITLE_MAX_CHARS] or None